@@ -0,0 +1,204 @@
+# -*- coding; utf-8 -*-
+""" A local table of the other names FAS users go by.
+
+Rules with ``recipient_nick2fas``, ``recipient_email2fas`` or
+``recipient_github2fas`` turn every awardee into a FAS username, which can
+mean a network call per awardee.  The ``AliasMap`` is bulk-loaded from
+fasjson at startup and refreshed in the background, and is consulted first.
+Whatever it doesn't know is looked up the old way, in one batch per rule,
+and remembered for a while too.
+
+OpenID URLs, Kerberos principals and dist-git URLs are turned into FAS
+usernames by parsing them, without asking anybody, so they aren't in here.
+"""
+
+import concurrent.futures
+import re
+import threading
+import time
+
+from fedbadges.utils import get_fasjson_session
+
+import logging
+log = logging.getLogger("moksha.hub")
+
+
+github_uri = re.compile('^https?://api.github.com/users/([a-z][a-z0-9-]+)$')
+
+
+def alias_key(kind, value):
+    """ The key a nick, email or github API URI is looked up by, or None. """
+    if not isinstance(value, str):
+        return None
+    if kind == 'github':
+        m = github_uri.search(value)
+        if not m:
+            return None
+        value = m.group(1)
+    return (kind, value.lower())
+
+
+def load_from_fasjson(config, page_size=1000):
+    """ Yield ``(kind, alias, username)`` for every user in fasjson. """
+    session = get_fasjson_session(config)
+    url = config['fasjson_base_url'] + "users/"
+    headers = {'X-Fields': 'username,emails,ircnicks,github_username'}
+    page = 1
+    while True:
+        response = session.get(url, headers=headers, params=dict(
+            page_size=page_size, page_number=page))
+        response.raise_for_status()
+        body = response.json()
+        for user in body['result']:
+            username = user['username']
+            for email in user.get('emails') or []:
+                yield 'email', email, username
+            for nick in user.get('ircnicks') or []:
+                # These look like irc:/nick or irc://server/nick
+                if nick.startswith('irc:'):
+                    yield 'nick', nick.rsplit('/', 1)[-1], username
+            if user.get('github_username'):
+                yield 'github', user['github_username'], username
+        if page >= body['page']['total_pages']:
+            break
+        page += 1
+
+
+class AliasMap(object):
+    """ Map ``(kind, alias)`` to a FAS username, each entry with its own TTL.
+
+    Loaded entries live until the next refresh replaces them (or ``ttl``,
+    should refreshing fail).  Entries learned from lookups live for ``ttl``
+    if they found somebody and ``negative_ttl`` if they didn't, refresh or
+    not.
+    """
+
+    def __init__(self, ttl=0, negative_ttl=0, workers=8,
+                 clock=time.monotonic):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.workers = workers
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def enabled(self):
+        return bool(self.ttl)
+
+    def configure(self, ttl, negative_ttl=0, workers=8):
+        with self._lock:
+            self.ttl = ttl
+            self.negative_ttl = negative_ttl
+            self.workers = workers
+            self._entries = {}
+
+    def load(self, aliases):
+        """ Replace our table with ``(kind, alias, username)`` triples. """
+        now = self.clock()
+        expires = now + self.ttl
+        entries = {}
+        for kind, alias, username in aliases:
+            if isinstance(alias, str):
+                entries[(kind, alias.lower())] = (expires, username, False)
+        with self._lock:
+            # Hang on to what we looked up ourselves in the meantime.
+            for key, entry in self._entries.items():
+                if entry[2] and key not in entries and entry[0] > now:
+                    entries[key] = entry
+            self._entries = entries
+        log.info("Loaded %i FAS aliases" % len(entries))
+
+    def start(self, loader, refresh):
+        """ Load from ``loader()`` now, and every ``refresh`` seconds after.
+        """
+        try:
+            self.load(loader())
+        except Exception as e:
+            log.exception("Could not load FAS aliases: %r" % e)
+
+        def run():
+            while not self._stop.wait(refresh):
+                try:
+                    self.load(loader())
+                except Exception as e:
+                    log.exception("Could not refresh FAS aliases: %r" % e)
+
+        self._thread = threading.Thread(target=run, name='fedbadges-aliases')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get(self, kind, value, default=None):
+        key = alias_key(kind, value)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= self.clock():
+            return default
+        return entry[1]
+
+    def resolve(self, kind, values, lookup, config):
+        """ Turn each of ``values`` into a FAS username (or None).
+
+        ``lookup(value, **config)`` is how we'd find out without the table.
+        It is called for everything the table doesn't know, all at once.
+        """
+        if not self.enabled:
+            return [lookup(value, **config) for value in values]
+
+        now = self.clock()
+        entries = self._entries
+        results = {}
+        missed = []
+        for value in values:
+            key = alias_key(kind, value)
+            entry = entries.get(key) if key else None
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                results[value] = entry[1]
+            elif key is None:
+                # Not something we keep; let lookup deal with it.
+                results[value] = lookup(value, **config)
+            else:
+                self.misses += 1
+                missed.append(value)
+
+        if missed:
+            for value, username in zip(missed, self._lookup(missed, lookup,
+                                                            config)):
+                results[value] = username
+            self._remember(kind, missed, results)
+
+        return [results[value] for value in values]
+
+    def _lookup(self, values, lookup, config):
+        if len(values) == 1 or self.workers < 2:
+            return [lookup(value, **config) for value in values]
+        with self._lock:
+            # Long-lived threads, so that they keep their fasjson sessions.
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='fedbadges-aliases')
+        return list(self._executor.map(lambda v: lookup(v, **config), values))
+
+    def _remember(self, kind, values, results):
+        now = self.clock()
+        with self._lock:
+            for value in values:
+                username = results[value]
+                ttl = self.ttl if username is not None else self.negative_ttl
+                if ttl:
+                    self._entries[alias_key(kind, value)] = (
+                        now + ttl, username, True)
+
+    def stats(self):
+        return dict(size=len(self._entries), hits=self.hits,
+                    misses=self.misses)
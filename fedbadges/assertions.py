@@ -0,0 +1,253 @@
+# -*- coding; utf-8 -*-
+""" A local index of who has been awarded which badge.
+
+Before checking the criteria of a rule, and again before awarding it, we need
+to know whether each awardee already has the badge.  Asking Badgr means an
+HTTP request per rule, per user, per message.  The ``AssertionIndex`` is
+loaded with every assertion of our issuer at startup, told about every badge
+we issue, and reconciled with Badgr every so often, so that the question is a
+set lookup instead.
+
+There are a few hundred badges and a few hundred thousand people who might
+hold them, so the index doesn't keep ``(badge, email)`` tuples.  Each email
+is interned to a small integer once, and each badge keeps the integers of
+its holders in an ``IdSet``.  Someone who holds no badge at all isn't
+interned, and is turned away without looking at any badge.
+"""
+
+import array
+import bisect
+import sys
+import threading
+
+from badgrclient import Issuer
+
+import logging
+log = logging.getLogger("moksha.hub")
+
+
+def recipient_identity(data):
+    """ The email an assertion was issued to, or None if we can't read it. """
+    recipient = data.get('recipient') or {}
+    if recipient.get('type', 'email') != 'email':
+        return None
+    identity = recipient.get('plaintextIdentity')
+    if not identity and not recipient.get('hashed'):
+        identity = recipient.get('identity')
+    if not isinstance(identity, str):
+        return None
+    return identity.lower()
+
+
+def load_from_badgr(client, issuer_id):
+    """ Yield ``(badge entityId, email)`` for every assertion of an issuer.
+    """
+    skipped = 0
+    for assertion in Issuer(client, issuer_id).fetch_assertions():
+        data = assertion.data or {}
+        if data.get('revoked'):
+            continue
+        email = recipient_identity(data)
+        if not email or not data.get('badgeclass'):
+            skipped += 1
+            continue
+        yield data['badgeclass'], email
+    if skipped:
+        log.warning("Could not read the recipients of %i assertions" %
+                    skipped)
+
+
+class IdSet(object):
+    """ A set of small non-negative integers, stored compactly.
+
+    Like a roaring bitmap container, it is a sorted array of 4 byte integers
+    while that is smaller than a bitmap up to its largest member, and a
+    bitmap after.  Most badges are held by a few people and are arrays; the
+    popular ones are bitmaps of one bit per person.
+
+    Only one thread may ``add`` at a time, but any may read meanwhile:  the
+    array is replaced rather than changed, and the bitmap only ever grows.
+    """
+
+    __slots__ = ('_store', '_count')
+
+    def __init__(self, ids=()):
+        store = array.array('I', sorted(set(ids)))
+        self._count = len(store)
+        if store and self._dense(store[-1]):
+            store = self._bitmap(store)
+        self._store = store
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, i):
+        store = self._store
+        if isinstance(store, bytearray):
+            byte = i >> 3
+            return byte < len(store) and bool(store[byte] & (1 << (i & 7)))
+        index = bisect.bisect_left(store, i)
+        return index < len(store) and store[index] == i
+
+    def add(self, i):
+        if i in self:
+            return
+        store = self._store
+        self._count += 1
+        if isinstance(store, bytearray):
+            byte = i >> 3
+            if byte >= len(store):
+                store.extend(bytes(byte + 1 - len(store)))
+            store[byte] |= 1 << (i & 7)
+            return
+        store = array.array('I', store)
+        bisect.insort(store, i)
+        if self._dense(store[-1]):
+            store = self._bitmap(store)
+        self._store = store
+
+    def _dense(self, largest):
+        return 4 * self._count > largest // 8 + 1
+
+    @staticmethod
+    def _bitmap(ids):
+        bits = bytearray(ids[-1] // 8 + 1)
+        for i in ids:
+            bits[i >> 3] |= 1 << (i & 7)
+        return bits
+
+    def nbytes(self):
+        """ How much memory this takes up, roughly. """
+        return sys.getsizeof(self) + sys.getsizeof(self._store)
+
+
+class AssertionIndex(object):
+    """ The set of ``(badge entityId, email)`` pairs that have been awarded.
+
+    Nothing is answered until ``load`` has been called once.  Pairs added
+    while a reload is under way are kept, even if Badgr didn't know about
+    them yet.
+
+    The ids are only meaningful for the holders they were interned with, so
+    the two are published together, as one tuple, and read together.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        # (email -> interned id, badge entityId -> IdSet of holders)
+        self._index = ({}, {})
+        self._added = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.hits = self.misses = self.negatives = 0
+
+    def __len__(self):
+        ids, awarded = self._index
+        return sum([len(holders) for holders in awarded.values()])
+
+    @property
+    def enabled(self):
+        return self.loaded
+
+    def load(self, loader):
+        """ Replace the index with the pairs ``loader()`` yields. """
+        with self._lock:
+            self._added = set()
+        ids = {}
+        holders = {}
+        try:
+            for badge_id, email in loader():
+                i = ids.setdefault(email.lower(), len(ids))
+                holders.setdefault(badge_id, []).append(i)
+        except Exception:
+            with self._lock:
+                self._added = None
+            raise
+        with self._lock:
+            for badge_id, email in self._added:
+                i = ids.setdefault(email, len(ids))
+                holders.setdefault(badge_id, []).append(i)
+            self._added = None
+            self._index = (ids, dict([
+                (badge_id, IdSet(members))
+                for badge_id, members in holders.items()]))
+            self.loaded = True
+        log.info("Loaded %i badge assertions for %i people, in %i KiB" % (
+            len(self), len(ids), self.nbytes() // 1024))
+
+    def start(self, loader, refresh):
+        """ Load from ``loader()`` now, and every ``refresh`` seconds after.
+        """
+        try:
+            self.load(loader)
+        except Exception as e:
+            log.exception("Could not load badge assertions: %r" % e)
+
+        def run():
+            while not self._stop.wait(refresh):
+                try:
+                    self.load(loader)
+                except Exception as e:
+                    log.exception("Could not reconcile badge assertions: %r"
+                                  % e)
+
+        self._thread = threading.Thread(target=run,
+                                        name='fedbadges-assertions')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def clear(self):
+        with self._lock:
+            self._index = ({}, {})
+            self.loaded = False
+
+    def add(self, badge_id, email):
+        """ Record that we've just awarded a badge. """
+        email = email.lower()
+        with self._lock:
+            ids, awarded = self._index
+            i = ids.get(email)
+            if i is None:
+                i = ids[email] = len(ids)
+            holders = awarded.get(badge_id)
+            if holders is None:
+                holders = awarded[badge_id] = IdSet()
+            holders.add(i)
+            if self._added is not None:
+                self._added.add((badge_id, email))
+
+    def has(self, badge_id, email):
+        """ Whether the badge has been awarded to this email. """
+        ids, awarded = self._index
+        i = ids.get(email.lower())
+        if i is None:
+            # They don't have any badge at all.
+            self.negatives += 1
+            return False
+        holders = awarded.get(badge_id)
+        if holders is not None and i in holders:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def nbytes(self):
+        """ How much memory the index takes up, roughly. """
+        ids, awarded = self._index
+        return (
+            sys.getsizeof(ids) +
+            sum([sys.getsizeof(email) for email in ids]) +
+            sys.getsizeof(awarded) +
+            sum([holders.nbytes() for holders in awarded.values()])
+        )
+
+    def stats(self):
+        ids, awarded = self._index
+        return dict(size=len(self), people=len(ids),
+                    badges=len(awarded), nbytes=self.nbytes(),
+                    hits=self.hits, misses=self.misses,
+                    negatives=self.negatives)
@@ -0,0 +1,184 @@
+# -*- coding; utf-8 -*-
+""" Awarding badges off the consumer's thread.
+
+Awarding a badge means a round trip or two to Badgr.  The ``AwardWriter``
+takes (badge, recipient) intents from the consumer and hands them to a few
+writer threads, so that evaluating the rules for the next message doesn't
+wait on Badgr.  Intents for a badge and recipient that are already queued
+or being written are dropped, which is what keeps the same badge from being
+issued twice to someone when two messages earn it at once.  Failed awards
+are retried, backing off a little more each time.
+
+With no writer threads, intents are awarded right away, on the caller's
+thread, as they always were.
+
+Given an ``AwardOutbox``, every intent is written to it before it is
+awarded and marked done after, and ``replay`` resubmits the ones that never
+were.
+"""
+
+import queue
+import threading
+import time
+
+import logging
+log = logging.getLogger("moksha.hub")
+
+
+class AwardWriter(object):
+    """ Call ``award(username, badge_rule, link)`` for each intent. """
+
+    def __init__(self, award, workers=0, batch=20, retries=3, backoff=1.0,
+                 sleep=time.sleep, outbox=None):
+        self.award = award
+        self.outbox = outbox
+        self.workers = workers
+        self.batch = batch
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._threads = []
+        self.submitted = self.duplicates = self.failures = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name='fedbadges-awards-%i' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ Let the writers finish what's queued, then stop them. """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def join(self):
+        """ Wait until everything submitted so far has been written. """
+        self._queue.join()
+
+    def submit(self, username, badge_rule, link=None):
+        """ Award ``badge_rule``'s badge to ``username``, sooner or later.
+
+        Returns False if that award was already on its way.
+        """
+        return self._submit(username, badge_rule, link)
+
+    def replay(self, rules):
+        """ Submit again every award in the outbox that was never done. """
+        if self.outbox is None:
+            return 0
+        by_badge = dict([(rule.badge_id, rule) for rule in rules
+                         if getattr(rule, 'badge_id', None)])
+        replayed = 0
+        for entry, badge_id, username, link in self.outbox.pending():
+            rule = by_badge.get(badge_id)
+            if rule is None:
+                log.warning("No rule for badge %r any more, not awarding it "
+                            "to %r" % (badge_id, username))
+                continue
+            try:
+                if self._submit(username, rule, link, entry):
+                    replayed += 1
+                else:
+                    # The same award is already on its way.
+                    self.outbox.done(entry)
+            except Exception as e:
+                log.exception("Replaying %r for %r failed: %r" % (
+                    rule, username, e))
+        log.info("Replayed %i awards from the outbox" % replayed)
+        return replayed
+
+    def _submit(self, username, badge_rule, link, entry=None):
+        key = (badge_rule.badge_id, username)
+        with self._lock:
+            if key in self._pending:
+                self.duplicates += 1
+                return False
+            self._pending.add(key)
+            self.submitted += 1
+
+        try:
+            if entry is None and self.outbox is not None:
+                entry = self.outbox.record(badge_rule.badge_id, username,
+                                           link)
+        except Exception:
+            self._done(key)
+            raise
+
+        if not self._threads:
+            try:
+                self.award(username, badge_rule, link)
+                self._done(key, entry)
+            except Exception:
+                self._done(key)
+                raise
+            return True
+
+        self._queue.put((key, entry, username, badge_rule, link))
+        return True
+
+    def _done(self, key, entry=None):
+        with self._lock:
+            self._pending.discard(key)
+        if entry is not None:
+            try:
+                self.outbox.done(entry)
+            except Exception as e:
+                # It'll be replayed, and found to be awarded already.
+                log.exception("Could not mark award %r done: %r" % (entry, e))
+
+    def _run(self):
+        while True:
+            intents = [self._queue.get()]
+            while intents[-1] is not None and len(intents) < self.batch:
+                try:
+                    intents.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Each writer takes just one of the Nones stop() queues.
+            stop = intents[-1] is None
+            if stop:
+                intents.pop()
+
+            # Write each badge's awards together, in the order they came.
+            intents.sort(key=lambda intent: str(intent[0][0]))
+            for key, entry, username, badge_rule, link in intents:
+                written = False
+                try:
+                    written = self._write(username, badge_rule, link)
+                finally:
+                    self._done(key, entry if written else None)
+
+            for i in range(len(intents) + stop):
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _write(self, username, badge_rule, link):
+        for attempt in range(self.retries + 1):
+            try:
+                self.award(username, badge_rule, link)
+                return True
+            except Exception as e:
+                if attempt == self.retries:
+                    self.failures += 1
+                    log.exception("Awarding %r to %r failed: %r" % (
+                        badge_rule, username, e))
+                    return False
+                delay = self.backoff * 2 ** attempt
+                log.warning("Awarding %r to %r failed (%r), retrying in %gs"
+                            % (badge_rule, username, e, delay))
+                self.sleep(delay)
+
+    def stats(self):
+        return dict(queued=self._queue.qsize(), pending=len(self._pending),
+                    submitted=self.submitted, duplicates=self.duplicates,
+                    failures=self.failures)
@@ -0,0 +1,71 @@
+# -*- coding; utf-8 -*-
+""" A Badgr client that every thread can share.
+
+``BadgrClient`` keeps one ``requests`` session and one token, and refreshes
+the token from whichever call notices it has expired.  That is fine for one
+thread.  The ``PooledBadgrClient`` gives each thread its own keep-alive
+session instead, lets only ``pool_size`` requests be in flight at once,
+refreshes the token once for everybody, and gives every request a timeout.
+How long each request took is recorded in ``fedbadges_request_seconds``.
+"""
+
+import datetime
+import threading
+
+import requests
+from badgrclient import BadgrClient
+
+import fedbadges.metrics as metrics
+
+
+class BadgrSession(requests.Session):
+    """ One thread's session, with its client's timeout and pool limit. """
+
+    def __init__(self, client):
+        super(BadgrSession, self).__init__()
+        self.client = client
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.client.timeout)
+        outcome = 'error'
+        with self.client._slots:
+            start = metrics.clock()
+            try:
+                response = super(BadgrSession, self).request(
+                    method, url, *args, **kwargs)
+                outcome = 'hit' if response.status_code < 400 else 'error'
+                return response
+            finally:
+                metrics.observe_request('badgr', method, start, outcome)
+
+
+class PooledBadgrClient(BadgrClient):
+    """ A thread-safe ``BadgrClient``. """
+
+    def __init__(self, *args, **kwargs):
+        self.pool_size = kwargs.pop('pool_size', 10)
+        self.timeout = kwargs.pop('timeout', 30)
+        self._local = threading.local()
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._token_lock = threading.Lock()
+        super(PooledBadgrClient, self).__init__(*args, **kwargs)
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = BadgrSession(self)
+        return session
+
+    @session.setter
+    def session(self, value):
+        # BadgrClient.__init__ makes one to share; we make one per thread.
+        pass
+
+    def _get_auth_token(self, *args, **kwargs):
+        with self._token_lock:
+            # Whoever got here first may have refreshed it for us already.
+            expires = self.token_expires_at
+            if expires is not None and expires > datetime.datetime.now():
+                return
+            super(PooledBadgrClient, self)._get_auth_token(*args, **kwargs)
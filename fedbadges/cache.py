@@ -0,0 +1,257 @@
+# -*- coding; utf-8 -*-
+""" In-process caches for fedbadges.
+
+Everything here is thread-safe, bounded in size, and keeps hit/miss counters
+so that it can be tuned from the logs.
+"""
+
+import collections
+import json
+import threading
+import time
+
+import logging
+log = logging.getLogger("moksha.hub")
+
+
+missing = object()
+
+
+class TTLCache(object):
+    """ A least-recently-used cache whose entries expire after a while.
+
+    A ``ttl`` or ``maxsize`` of zero disables the cache entirely.
+    """
+
+    def __init__(self, ttl=0, maxsize=0, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def enabled(self):
+        return bool(self.ttl and self.maxsize)
+
+    def configure(self, ttl, maxsize):
+        with self._lock:
+            self.ttl = ttl
+            self.maxsize = maxsize
+            self._data.clear()
+
+    def _valid(self, key, entry, now):
+        return entry[0] > now
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        now = self.clock()
+        with self._lock:
+            entry = self._data.get(key, missing)
+            if entry is missing:
+                self.misses += 1
+                return default
+            if not self._valid(key, entry, now):
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None, *extra):
+        if not self.enabled:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (self.clock() + ttl, value) + extra
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, missing)
+        if entry is missing:
+            return default
+        return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return dict(
+            size=len(self._data),
+            maxsize=self.maxsize,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+        )
+
+
+class ExistenceCache(TTLCache):
+    """ Whether things exist, remembering the answer "no" for less long.
+
+    A ``negative_ttl`` of zero means only "yes" is remembered.
+    """
+
+    def __init__(self, ttl=0, maxsize=0, negative_ttl=0, **kwargs):
+        super(ExistenceCache, self).__init__(ttl, maxsize, **kwargs)
+        self.negative_ttl = negative_ttl
+
+    def configure(self, ttl, maxsize, negative_ttl=0):
+        super(ExistenceCache, self).configure(ttl, maxsize)
+        self.negative_ttl = negative_ttl
+
+    def put(self, key, exists):
+        if exists:
+            self.set(key, True)
+        elif self.negative_ttl:
+            self.set(key, False, self.negative_ttl)
+
+
+class QueryMemo(object):
+    """ The results of the queries run on behalf of one message.
+
+    When a message triggers several rules asking datanommer the same thing
+    (a badge series, typically), the query is only run for the first of
+    them; the others get its result.  If two threads ask for the same key at
+    once, the second waits for the first rather than running it again.
+    """
+
+    def __init__(self):
+        self._results = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key, compute):
+        """ Return the result for ``key``, calling ``compute()`` if need be """
+        with self._lock:
+            entry = self._results.get(key)
+            owner = entry is None
+            if owner:
+                # [done, result, exception]
+                entry = self._results[key] = [threading.Event(), None, None]
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if owner:
+            try:
+                entry[1] = compute()
+            except Exception as e:
+                entry[2] = e
+                raise
+            finally:
+                entry[0].set()
+            return entry[1]
+
+        entry[0].wait()
+        if entry[2] is not None:
+            raise entry[2]
+        return entry[1]
+
+
+class CriteriaCache(TTLCache):
+    """ Results of datanommer criteria, keyed on the rendered query.
+
+    On top of expiring after ``ttl`` seconds, a result is dropped as soon as
+    a message arrives which could be part of it; that is, a message from one
+    of the ``users`` in its filter or, failing that, on one of its ``topics``
+    or ``categories``.  The consumer tells us about every message through
+    ``message_arrived``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CriteriaCache, self).__init__(*args, **kwargs)
+        # When we last saw a message for each user, topic, category.
+        self._seen = {}
+        self._pruned = self.clock()
+        self.invalidations = 0
+
+    @staticmethod
+    def key(kwargs, operation):
+        """ A canonical, hashable form of a datanommer query """
+        return json.dumps([kwargs, operation], sort_keys=True, default=repr)
+
+    @staticmethod
+    def dependencies(kwargs):
+        """ Which incoming messages could change the result of a query """
+        for kind, field in [('user', 'users'),
+                            ('topic', 'topics'),
+                            ('category', 'categories')]:
+            values = kwargs.get(field)
+            if values and isinstance(values, list) and \
+                    all([isinstance(v, str) for v in values]):
+                return tuple([(kind, value.lower()) for value in values])
+        return (('any', None),)
+
+    def _valid(self, key, entry, now):
+        expires, value, created, dependencies = entry
+        if expires <= now:
+            return False
+        for dependency in dependencies:
+            if self._seen.get(dependency, created - 1) >= created:
+                self.invalidations += 1
+                return False
+        return True
+
+    def now(self):
+        """ Call this before running a query, and hand it to ``put`` after """
+        return self.clock()
+
+    def lookup(self, kwargs, operation):
+        return self.get(self.key(kwargs, operation), missing)
+
+    def put(self, kwargs, operation, value, since):
+        """ Store the result of a query which was started at ``since`` """
+        # Count the ttl from when the query started, not from now.
+        ttl = since + self.ttl - self.clock()
+        if ttl > 0:
+            self.set(self.key(kwargs, operation), value, ttl,
+                     since, self.dependencies(kwargs))
+
+    def message_arrived(self, usernames, topic):
+        if not self.enabled:
+            return
+        now = self.clock()
+        with self._lock:
+            seen = self._seen
+            seen[('any', None)] = now
+            for username in usernames:
+                seen[('user', username.lower())] = now
+            if isinstance(topic, str):
+                seen[('topic', topic.lower())] = now
+                parts = topic.split('.', 4)
+                if len(parts) > 3:
+                    seen[('category', parts[3].lower())] = now
+
+            # Anything older than our ttl can't invalidate anything anymore.
+            if now - self._pruned > self.ttl:
+                cutoff = now - self.ttl
+                for dependency in [d for d, t in seen.items() if t < cutoff]:
+                    del seen[dependency]
+                self._pruned = now
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._seen.clear()
+
+    def stats(self):
+        stats = super(CriteriaCache, self).stats()
+        stats['invalidations'] = self.invalidations
+        return stats
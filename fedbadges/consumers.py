@@ -4,7 +4,12 @@
 Authors:  Ross Delinger
           Ralph Bean
 """
+import collections
+import concurrent.futures
+import functools
+import itertools
 import os.path
+import sys
 import yaml
 import traceback
 import transaction
@@ -12,12 +17,23 @@ import threading
 import time
 
 import fedmsg.consumers
+import fedmsg.meta
 
 import datanommer.models
-from badgrclient import BadgrClient, Assertion, BadgeClass, Issuer
-
+from badgrclient import Assertion, BadgeClass, Issuer
+
+import fedbadges.aliases
+import fedbadges.assertions
+import fedbadges.awards
+import fedbadges.badgr
+import fedbadges.counters
+import fedbadges.dispatch
+import fedbadges.metrics
+import fedbadges.outbox
 import fedbadges.rules
-from fedbadges.utils import assertion_exists
+import fedbadges.snapshot
+import fedbadges.utils
+from fedbadges.utils import assertion_exists, Substitutions
 
 import logging
 log = logging.getLogger("moksha.hub")
@@ -30,11 +46,12 @@ class FedoraBadgesConsumer(fedmsg.consumers.FedmsgConsumer):
     config_key = "fedmsg.consumers.badges.enabled"
     consume_delay = 3
     delay_limit = 100
+    concurrency = 1
 
     def __init__(self, hub):
         self.badge_rules = []
+        self.rule_index = fedbadges.dispatch.RuleIndex([])
         self.hub = hub
-        self.lock = threading.Lock()
 
         super(FedoraBadgesConsumer, self).__init__(hub)
 
@@ -43,6 +60,94 @@ class FedoraBadgesConsumer(fedmsg.consumers.FedmsgConsumer):
         self.delay_limit = int(self.hub.config.get('badges.delay_limit',
                                                    self.delay_limit))
 
+        # Remember who exists in FAS, and for a shorter while who doesn't.
+        fedbadges.utils.fas_cache.configure(
+            ttl=float(self.hub.config.get('badges.fas_cache.ttl', 0)),
+            maxsize=int(self.hub.config.get('badges.fas_cache.size', 8192)),
+            negative_ttl=float(self.hub.config.get(
+                'badges.fas_cache.negative_ttl', 0)),
+        )
+
+        # Keep a table of everybody's IRC nicks, emails and GitHub accounts.
+        ttl = float(self.hub.config.get('badges.aliases.ttl', 0))
+        if ttl:
+            fedbadges.rules.alias_map.configure(
+                ttl=ttl,
+                negative_ttl=float(self.hub.config.get(
+                    'badges.aliases.negative_ttl', 0)),
+                workers=int(self.hub.config.get('badges.aliases.workers', 8)),
+            )
+            fedbadges.rules.alias_map.start(
+                functools.partial(fedbadges.aliases.load_from_fasjson,
+                                  self.hub.config),
+                refresh=float(self.hub.config.get(
+                    'badges.aliases.refresh', ttl / 2)),
+            )
+
+        # Time every stage of every rule, and serve that up for scraping.
+        fedbadges.metrics.enabled = bool(
+            self.hub.config.get('badges.metrics.enabled', False))
+        port = int(self.hub.config.get('badges.metrics.port', 0))
+        if fedbadges.metrics.enabled and port:
+            fedbadges.metrics.serve(
+                port, self.hub.config.get('badges.metrics.address', ''))
+
+        # How many rules to evaluate at once for each message.  With more
+        # than one, their criteria are checked by a pool of threads.
+        self.concurrency = int(self.hub.config.get('badges.concurrency',
+                                                   self.concurrency))
+        self.executor = None
+        if self.concurrency > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency,
+                thread_name_prefix='fedbadges',
+            )
+
+        # And how many datanommer queries may be in flight at once, overall.
+        connections = int(self.hub.config.get('badges.datanommer_connections',
+                                              0))
+        if connections > 0:
+            fedbadges.rules.datanommer_budget = \
+                threading.BoundedSemaphore(connections)
+
+        # Check criteria in the order they're written in, for debugging.
+        fedbadges.rules.pin_criteria_order = bool(
+            self.hub.config.get('badges.criteria.pin_order', False))
+
+        # Only count as far as each count criteria needs to.
+        bounded = self.hub.config.get('badges.bounded_counts', False)
+        if bounded and not hasattr(datanommer.models.Message, 'make_query'):
+            log.warning("This datanommer can't do bounded counts")
+            bounded = False
+        fedbadges.rules.bounded_counts = bool(bounded)
+
+        # Write down every award before making it, if we're given somewhere
+        # to, so that none are lost while Badgr is down.
+        outbox = None
+        path = self.hub.config.get('badges.awards.outbox')
+        if path:
+            outbox = fedbadges.outbox.AwardOutbox(path)
+            outbox.compact()
+
+        # Award badges from a few threads of their own, so that nobody waits
+        # on Badgr.  With no workers, they're awarded as they're earned.
+        self.awards = fedbadges.awards.AwardWriter(
+            lambda *args: self.award_badge(*args),
+            workers=int(self.hub.config.get('badges.awards.workers', 0)),
+            batch=int(self.hub.config.get('badges.awards.batch', 20)),
+            retries=int(self.hub.config.get('badges.awards.retries', 3)),
+            backoff=float(self.hub.config.get('badges.awards.backoff', 1)),
+            outbox=outbox,
+        )
+        self.awards.start()
+
+        # Remember the results of datanommer criteria for a while.
+        fedbadges.rules.criteria_cache.configure(
+            ttl=float(self.hub.config.get('badges.criteria_cache.ttl', 0)),
+            maxsize=int(self.hub.config.get('badges.criteria_cache.size',
+                                            4096)),
+        )
+
         # Five things need doing at start up time
         # 0) Set up a request local to hang thread-safe db sessions on.
         # 1) Initialize our badgrclient connection
@@ -56,6 +161,15 @@ class FedoraBadgesConsumer(fedmsg.consumers.FedmsgConsumer):
         # Badgr stuff.
         self._initialize_badgr_connection()
 
+        # Know who has which badge without asking Badgr every time.
+        refresh = float(self.hub.config.get('badges.assertions.refresh', 0))
+        if refresh:
+            fedbadges.rules.assertion_index.start(
+                functools.partial(fedbadges.assertions.load_from_badgr,
+                                  self.badgr_client, self.issuer_id),
+                refresh=refresh,
+            )
+
         # Datanommer stuff
         self._initialize_datanommer_connection()
 
@@ -63,6 +177,13 @@ class FedoraBadgesConsumer(fedmsg.consumers.FedmsgConsumer):
         directory = hub.config.get("badges.yaml.directory", "badges_yaml_dir")
         self.badge_rules = self._load_badges_from_yaml(directory)
 
+        # Count messages ourselves, if asked to
+        if self.hub.config.get('badges.counters.enabled', False):
+            self._seed_counters(self.badge_rules)
+
+        # Finish awarding whatever we didn't get to last time.
+        self.awards.replay(self.badge_rules)
+
     def _initialize_badgr_connection(self):
         global_settings = self.hub.config.get("badges_global", {})
         badgr_user = global_settings.get('badgr_user')
@@ -81,13 +202,16 @@ class FedoraBadgesConsumer(fedmsg.consumers.FedmsgConsumer):
         client_id = badgr_user.get('client_id')
         base_url = badgr_user.get('base_url')
 
-        self.l.badgr_client = BadgrClient(
+        # One client for every thread, rules and award writers alike.
+        self.badgr_client = fedbadges.badgr.PooledBadgrClient(
             username=username,
             password=password,
             client_id=client_id,
             scope=BADGR_SCOPE,
             base_url=base_url,
-            unique_badge_names=True
+            unique_badge_names=True,
+            pool_size=int(self.hub.config.get('badges.badgr.pool_size', 10)),
+            timeout=float(self.hub.config.get('badges.badgr.timeout', 30)),
         )
 
         issuer = global_settings.get('badge_issuer')
@@ -98,7 +222,7 @@ class FedoraBadgesConsumer(fedmsg.consumers.FedmsgConsumer):
             self.issuer_id = issuer_eid
         else:
             # or search the existing issuers
-            existing_issuers = self.l.badgr_client.fetch_issuer()
+            existing_issuers = self.badgr_client.fetch_issuer()
             issuer_name = issuer.get('issuer_name')
 
             for issuer in existing_issuers:
@@ -107,7 +231,7 @@ class FedoraBadgesConsumer(fedmsg.consumers.FedmsgConsumer):
                     break
 
         if not self.issuer_id:
-            new_issuer = Issuer(self.l.badgr_client).create(
+            new_issuer = Issuer(self.badgr_client).create(
                 name=issuer_name,
                 email=issuer.get('issuer_email'),
                 description=issuer.get('issuer_origin'),
@@ -118,40 +242,133 @@ class FedoraBadgesConsumer(fedmsg.consumers.FedmsgConsumer):
             self.issuer_id = new_issuer.entityId
 
         # Load the existing badges
-        self.l.badgr_client.load_badge_names(self.issuer_id)
+        self.badgr_client.load_badge_names(self.issuer_id)
 
     def _initialize_datanommer_connection(self):
         datanommer.models.init(self.hub.config['datanommer.sqlalchemy.url'])
 
     def _load_badges_from_yaml(self, directory):
-        # badges indexed by trigger
-        badges = []
+        files = []
         directory = os.path.abspath(directory)
         log.info("Looking in %r to load badge definitions" % directory)
-        for root, dirs, files in os.walk(directory):
-            for partial_fname in files:
+        for root, dirs, filenames in os.walk(directory):
+            for partial_fname in filenames:
                 fname = root + "/" + partial_fname
-                badge = self._load_badge_from_yaml(fname)
+                try:
+                    with open(fname, 'rb') as f:
+                        files.append((fname, f.read()))
+                except Exception as e:
+                    log.error("Loading %r failed with %r" % (fname, e))
+
+        # If none of those have changed since last time, we know what's in
+        # them and that Badgr has them all.
+        snapshot = cached = None
+        path = self.hub.config.get('badges.yaml.snapshot')
+        if path:
+            snapshot = fedbadges.snapshot.RulesetSnapshot(path)
+            key = fedbadges.snapshot.digest(files, self.issuer_id)
+            cached = snapshot.load(key)
+
+        if cached:
+            log.info("Loading badge definitions from %r" % path)
+            definitions, badge_ids = cached
+        else:
+            definitions = []
+            for fname, content in files:
+                badge = self._load_badge_from_yaml(fname, content)
 
                 if not badge:
                     continue
 
-                try:
-                    badge_rule = fedbadges.rules.BadgeRule(
-                        badge, self.l.badgr_client, self.issuer_id)
-                    badges.append(badge_rule)
-                except ValueError as e:
-                    log.error("Initializing rule for %r failed with %r" % (
-                        fname, e))
+                definitions.append((fname, badge))
+
+            # Make sure Badgr has every badge before we build the rules for
+            # them.
+            badge_ids = self._sync_badge_classes(
+                [badge for fname, badge in definitions])
+
+        # badges indexed by trigger
+        badges = []
+        for fname, badge in definitions:
+            try:
+                badge_rule = fedbadges.rules.BadgeRule(
+                    badge, self.badgr_client, self.issuer_id,
+                    badge_id=badge_ids.get(badge.get('name')),
+                )
+                badges.append(badge_rule)
+            except ValueError as e:
+                log.error("Initializing rule for %r failed with %r" % (
+                    fname, e))
 
         log.info("Loaded %i total badge definitions" % len(badges))
+
+        if snapshot and not cached:
+            snapshot.save(key, definitions, dict(
+                [(badge['name'], badge.badge_id) for badge in badges
+                 if getattr(badge, 'badge_id', None)]))
+
+        # Rules counting the same thing count as far as the furthest of them.
+        fedbadges.rules.share_count_limits(badges)
+
+        # Index the rules by what their triggers look for, so that consume()
+        # only needs to consider the ones that might match a given message.
+        self.rule_index = fedbadges.dispatch.RuleIndex(badges)
         return badges
 
-    def _load_badge_from_yaml(self, fname):
+    def _sync_badge_classes(self, badges):
+        """ Return the entity id of each badge's class in Badgr, by name.
+
+        All of the issuer's badge classes were listed when we connected.
+        Those missing are created here, a few at a time.  Any we fail to
+        create are left for the BadgeRule to try again.
+        """
+        client = self.badgr_client
+        badge_ids = {}
+        missing = {}
+        for badge in badges:
+            try:
+                fedbadges.rules.BadgeRule.check_fields(badge)
+            except (AttributeError, KeyError, ValueError):
+                # The BadgeRule will tell them all about it.
+                continue
+            name = badge['name']
+            badge_id = client.get_eid_from_badge_name(name, self.issuer_id)
+            if badge_id:
+                badge_ids[name] = badge_id
+            else:
+                missing.setdefault(name, badge)
+
+        unused = set(client.badge_names.get(self.issuer_id) or []).difference(
+            [badge['name'] for badge in badges if isinstance(badge, dict)])
+        log.info("%i badges in Badgr, %i to create, %i without a rule" % (
+            len(badge_ids), len(missing), len(unused)))
+        if not missing:
+            return badge_ids
+
+        workers = int(self.hub.config.get('badges.badgr.sync_workers', 8))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix='fedbadges-sync') as executor:
+            futures = dict([
+                (executor.submit(fedbadges.rules.create_badge_class,
+                                 client, badge, self.issuer_id), name)
+                for name, badge in missing.items()
+            ])
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    badge_ids[name] = future.result()
+                except Exception as e:
+                    log.error("Creating badge %r failed with %r" % (name, e))
+        return badge_ids
+
+    def _load_badge_from_yaml(self, fname, content=None):
         log.debug("Loading %r" % fname)
         try:
-            with open(fname, 'r') as f:
-                return yaml.safe_load(f.read())
+            if content is None:
+                with open(fname, 'r') as f:
+                    content = f.read()
+            return yaml.safe_load(content)
         except Exception as e:
             log.error("Loading %r failed with %r" % (fname, e))
             return None
@@ -174,21 +391,29 @@ class FedoraBadgesConsumer(fedmsg.consumers.FedmsgConsumer):
 
         client = badge_rule.client
 
-        # TODO: Optimize this
         # Say that someone adds 2 tags to a package in fedora-tagger all at
-        # once.  That produces 2 different fedmsg messages that each hit
-        # this daemon.  Each message gets handed off to each of 2 worker
-        # threads that start working in parallel. This way issue will get
-        # called twice and the user will get the same badge awarded twice.
-        # So we use a lock here to prevent this.
-        # (Note that multiple instances of the same badge can be awarded to
-        # the same recipient via badgr-server)
-        with self.lock():
+        # once.  That produces 2 different fedmsg messages that could both
+        # earn them the same badge.  badgr-server would happily issue it
+        # twice, so self.awards never writes the same badge for the same
+        # user from two threads at once; the second one finds it here.
+        start = fedbadges.metrics.clock()
+        outcome = 'error'
+        try:
             badge_to_award = BadgeClass(client, eid=badge_rule.badge_id)
+            # Badgr, not the index, has the last word on this.
             badge_has_been_awarded = assertion_exists(badge_to_award, email)
 
             if not badge_has_been_awarded:
                 badge_to_award.issue(recipient_email=email)
+                index = fedbadges.rules.assertion_index
+                if index.enabled:
+                    index.add(badge_rule.badge_id, email)
+                outcome = 'hit'
+            else:
+                outcome = 'skip'
+        finally:
+            fedbadges.metrics.observe(badge_rule['name'], 'award', start,
+                                      outcome)
 
     def consume(self, msg):
 
@@ -212,6 +437,12 @@ class FedoraBadgesConsumer(fedmsg.consumers.FedmsgConsumer):
         # Strip the moksha envelope
         msg = msg['body']
 
+        # Any cached criteria this message could be counted in are now stale,
+        # and it needs counting.  We do this after the sleep above, once
+        # datanommer has (hopefully) stored the message, so that nothing
+        # cached before then survives.
+        self._message_arrived(msg)
+
         default = "https://apps.fedoraproject.org/datagrepper"
         link = self.hub.config.get('fedbadges.datagrepper_url', default) + \
             "/id?id=%s&is_raw=true&size=extra-large" % msg['msg_id']
@@ -219,16 +450,102 @@ class FedoraBadgesConsumer(fedmsg.consumers.FedmsgConsumer):
         # Define this so we can refer to it in error handling below
         badge_rule = None
 
-        # Initialize our connection if this is the first time we are called.
-        self._initialize_tahrir_connection()
+        # Build the substitutions for this message once, lazily, and share
+        # them between all the rules.
+        subs = Substitutions(msg)
 
-        # Award every badge as appropriate.
+        # Award every badge as appropriate.  However the rules are evaluated,
+        # we award and log in the order the rules were loaded.
         log.debug("Received %s, %s" % (msg['topic'], msg['msg_id']))
-        for badge_rule in self.badge_rules:
+        rules = self.rule_index.candidates(msg, subs)
+        for badge_rule, recipients, error in self._evaluate(rules, msg, subs):
+            if error:
+                log.error("Rule: %r, message: %r" % (badge_rule, msg),
+                          exc_info=error)
+                continue
             try:
-                for recipient in badge_rule.matches(msg):
-                    self.award_badge(recipient, badge_rule, link)
+                for recipient in sorted(recipients):
+                    self.awards.submit(recipient, badge_rule, link)
             except Exception as e:
                 log.exception("Rule: %r, message: %r" % (badge_rule, msg))
 
         log.debug("Done with %s, %s" % (msg['topic'], msg['msg_id']))
+
+    def stop(self):
+        # Don't drop the awards we've queued up.
+        self.awards.stop()
+        if self.awards.outbox is not None:
+            self.awards.outbox.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        super(FedoraBadgesConsumer, self).stop()
+
+    def _evaluate(self, rules, msg, subs):
+        """ Yield each rule, who it awards and any error raised, in order.
+
+        Without an executor, each rule is evaluated as it is asked for.  With
+        one, the rules whose triggers match are evaluated in the background,
+        no more than ``concurrency`` of them at a time.
+        """
+        def evaluate(rule, triggered=False):
+            try:
+                return rule, rule.matches(msg, subs, triggered=triggered), None
+            except Exception:
+                return rule, None, sys.exc_info()
+            finally:
+                # Don't keep a datanommer connection checked out between
+                # messages, whichever thread we're on.
+                datanommer.models.session.remove()
+
+        if self.executor is None:
+            for rule in rules:
+                yield evaluate(rule)
+            return
+
+        # Triggers are cheap.  Only farm out the rules that get past them,
+        # and don't have them checked again there.
+        rules = iter([rule for rule in rules
+                      if rule.trigger_matches(msg, subs)])
+        pending = collections.deque([
+            self.executor.submit(evaluate, rule, True)
+            for rule in itertools.islice(rules, self.concurrency)
+        ])
+        while pending:
+            result = pending.popleft().result()
+            rule = next(rules, None)
+            if rule is not None:
+                pending.append(self.executor.submit(evaluate, rule, True))
+            yield result
+
+    def _message_arrived(self, msg):
+        cache = fedbadges.rules.criteria_cache
+        counters = fedbadges.rules.counter_store
+        if not cache.enabled and not counters.enabled:
+            return
+        try:
+            usernames = fedmsg.meta.msg2usernames(msg)
+        except Exception as e:
+            # We can't tell who this is about, so we can't trust anything.
+            log.exception("Clearing the criteria cache: %r" % e)
+            cache.clear()
+            if counters.enabled:
+                log.error("Message counters no longer accurate, dropping them")
+                counters.clear()
+            return
+        if cache.enabled:
+            cache.message_arrived(usernames, msg.get('topic'))
+            log.debug("Criteria cache: %r" % cache.stats())
+        if counters.enabled:
+            counters.message_arrived(msg, usernames)
+            log.debug("Message counters: %r" % counters.stats())
+
+    def _seed_counters(self, badges):
+        """ Seed the local message counters for the loaded rules. """
+        categories = set(self.hub.config.get('badges.counters.categories', []))
+        for badge in badges:
+            categories.update(fedbadges.counters.count_categories(badge))
+        try:
+            fedbadges.rules.counter_store.seed(categories)
+        except Exception as e:
+            log.exception("Could not seed message counters: %r" % e)
+            fedbadges.rules.counter_store.clear()
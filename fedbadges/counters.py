@@ -0,0 +1,250 @@
+# -*- coding; utf-8 -*-
+""" Local message counters, as a stand-in for datanommer.
+
+Most criteria are a ``count`` of somebody's messages on some topics or
+categories.  Since we see every message on the bus anyway, we can keep those
+counts ourselves:  the ``CounterStore`` is seeded from datanommer once, at
+startup, with one GROUP BY over the categories the ruleset cares about, and
+the consumer tells it about every message after that.  It then answers the
+count filters it can represent without a round trip to the database, and
+says so (by returning None) for those it can't.
+"""
+
+import calendar
+import collections
+import datetime
+import threading
+
+import sqlalchemy
+
+import datanommer.models
+
+import fedbadges.dispatch
+
+import logging
+log = logging.getLogger("moksha.hub")
+
+
+def topic_category(topic):
+    """ The category of a topic, the same way datanommer works it out. """
+    if not isinstance(topic, str):
+        return None
+    index = 2 if 'VirtualTopic' in topic else 3
+    parts = topic.split('.')
+    if len(parts) > index:
+        return parts[index]
+    return None
+
+
+def count_categories(rule):
+    """ Return the categories whose counts a rule might ask for.
+
+    That is, the literal topics and categories of the count filters in its
+    criteria and, for filters which take them from the message (like
+    ``%(topic)s``), the categories its trigger is restricted to.
+    """
+    categories = set()
+    from_message = False
+    stack = [rule.criteria]
+    while stack:
+        criteria = stack.pop()
+        if criteria.children:
+            stack.extend(criteria.children)
+            continue
+        specialization = criteria.specialization
+        if specialization._d.get('operation') != 'count':
+            continue
+        filter = specialization._d['filter']
+        for field in ('topics', 'categories'):
+            for value in filter.get(field) or []:
+                if not isinstance(value, str):
+                    continue
+                if '%' in value:
+                    from_message = True
+                elif field == 'topics':
+                    categories.add(topic_category(value))
+                else:
+                    categories.add(value)
+
+    if from_message:
+        for key in fedbadges.dispatch.index_keys(rule.trigger) or []:
+            if key[0] == 'category':
+                categories.add(key[1])
+            elif key[0] == 'topic':
+                categories.add(topic_category(key[1]))
+
+    categories.discard(None)
+    return categories
+
+
+class CounterStore(object):
+    """ Per-user message counts, by topic and by category.
+
+    Nothing is answered until ``seed`` (or ``load``) has been called.  The
+    seed counts what datanommer had up to its newest message, the
+    ``watermark``.  Datanommer lags behind the bus, so messages from the
+    ``overlap`` seconds before that may still come by:  those it had are
+    skipped by their msg_id, as are messages that come by twice.
+    """
+
+    # How far behind its newest message datanommer may still be storing.
+    overlap = 600
+
+    # How many msg_ids to remember.
+    seen_size = 100000
+
+    def __init__(self):
+        self.categories = frozenset()
+        self.watermark = None
+        self._counts = {}
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+    @property
+    def enabled(self):
+        return self.watermark is not None
+
+    def seed(self, categories):
+        """ Load counts for these categories from datanommer. """
+        Message = datanommer.models.Message
+        User = datanommer.models.User
+        session = datanommer.models.session
+        categories = sorted(categories)
+        log.info("Seeding message counters for %i categories" %
+                 len(categories))
+
+        # Count up to the newest message datanommer has, not up to now.
+        cutoff = session.query(sqlalchemy.func.max(Message.timestamp)).filter(
+            Message.category.in_(categories),
+        ).scalar()
+        if cutoff is None:
+            self.load([], categories, 0.0)
+            return
+        watermark = calendar.timegm(cutoff.utctimetuple()) + \
+            cutoff.microsecond / 1000000.0
+
+        query = session.query(
+            User.name,
+            Message.category,
+            Message.topic,
+            sqlalchemy.func.count(Message.id),
+        ).select_from(Message).join(Message.users).filter(
+            Message.category.in_(categories),
+            Message.timestamp <= cutoff,
+        ).group_by(User.name, Message.category, Message.topic)
+        rows = query.all()
+
+        since = cutoff - datetime.timedelta(seconds=self.overlap)
+        msg_ids = session.query(Message.msg_id).filter(
+            Message.category.in_(categories),
+            Message.timestamp > since,
+            Message.timestamp <= cutoff,
+        ).all()
+        self.load(rows, categories, watermark,
+                  [msg_id for msg_id, in msg_ids])
+        log.info("Seeded %i message counters" % len(self._counts))
+
+    def load(self, rows, categories, watermark, msg_ids=()):
+        """ Load ``(user, category, topic, count)`` rows, as of ``watermark``.
+
+        ``msg_ids`` are those of the counted messages from the ``overlap``
+        before it.
+        """
+        counts = {}
+        for user, category, topic, count in rows:
+            key = (user, 'topics', topic)
+            counts[key] = counts.get(key, 0) + count
+            key = (user, 'categories', category)
+            counts[key] = counts.get(key, 0) + count
+        seen = collections.OrderedDict.fromkeys(msg_ids)
+        with self._lock:
+            self._counts = counts
+            self._seen = seen
+            self.categories = frozenset(categories)
+            self.watermark = watermark
+
+    def clear(self):
+        with self._lock:
+            self._counts = {}
+            self._seen = collections.OrderedDict()
+            self.categories = frozenset()
+            self.watermark = None
+
+    def message_arrived(self, msg, usernames):
+        if not self.enabled:
+            return
+        topic = msg.get('topic')
+        category = topic_category(topic)
+        if category not in self.categories:
+            return
+        msg_id = msg.get('msg_id')
+        timestamp = msg.get('timestamp')
+        if isinstance(timestamp, (int, float)):
+            # Datanommer had everything from before the overlap.  Without a
+            # msg_id, we can't tell what it had from during it.
+            before = self.watermark - (self.overlap if msg_id else 0)
+            if timestamp <= before:
+                return
+        with self._lock:
+            if msg_id:
+                if msg_id in self._seen:
+                    # Counted already, by the seed or on its first delivery.
+                    return
+                self._seen[msg_id] = None
+                if len(self._seen) > self.seen_size:
+                    self._seen.popitem(last=False)
+            counts = self._counts
+            for user in set(usernames):
+                for key in [(user, 'topics', topic),
+                            (user, 'categories', category)]:
+                    counts[key] = counts.get(key, 0) + 1
+
+    def count(self, kwargs):
+        """ Count the messages matching a datanommer filter.
+
+        Only filters on exactly one user and on some topics or some
+        categories (but not both) can be answered.  For anything else, return
+        None.
+        """
+        if not self.enabled or not self._representable(kwargs):
+            self.misses += 1
+            return None
+        user = kwargs['users'][0]
+        field = 'topics' if 'topics' in kwargs else 'categories'
+        counts = self._counts
+        self.hits += 1
+        return sum([counts.get((user, field, value), 0)
+                    for value in set(kwargs[field])])
+
+    def _representable(self, kwargs):
+        if set(kwargs.keys()) not in ({'users', 'topics'},
+                                      {'users', 'categories'}):
+            return False
+        users = kwargs['users']
+        if not isinstance(users, list) or len(users) != 1 or \
+                not isinstance(users[0], str):
+            return False
+        field = 'topics' if 'topics' in kwargs else 'categories'
+        values = kwargs[field]
+        if not isinstance(values, list) or not values:
+            return False
+        for value in values:
+            if not isinstance(value, str):
+                return False
+            if field == 'topics':
+                value = topic_category(value)
+            if value not in self.categories:
+                return False
+        return True
+
+    def stats(self):
+        return dict(
+            size=len(self._counts),
+            categories=len(self.categories),
+            hits=self.hits,
+            misses=self.misses,
+        )
@@ -0,0 +1,203 @@
+# -*- coding; utf-8 -*-
+""" Dispatching of incoming messages to the BadgeRules that may match them.
+
+Most triggers are plain ``topic``, ``category``, ``field`` or ``contains``
+leaves, or ``any``/``all`` combinations of them.  Rather than evaluating
+every trigger against every message that comes across the bus, the consumer
+asks a ``RuleIndex`` for the handful of rules which *could* match and only
+evaluates those.  Rules whose triggers can't be reasoned about ahead of time
+(lambdas, negations) are always handed back as candidates.
+"""
+
+import logging
+log = logging.getLogger("moksha.hub")
+
+from fedbadges.utils import path_accessor, Substitutions
+
+ahocorasick = None
+try:
+    import ahocorasick
+except ImportError as e:
+    log.info("Could not import ahocorasick, using plain substring search")
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def index_keys(trigger):
+    """ Return the index keys a message must hit for a trigger to match.
+
+    Keys are ``('topic', suffix)``, ``('category', name)``,
+    ``('contains', pattern)`` or ``('field', path, value)`` tuples.  If the
+    trigger can't be described that way, return None.
+    """
+    if trigger.children:
+        if trigger.attribute == 'any':
+            # Any one of our children may match, so we need all their keys.
+            keys = set()
+            for child in trigger.children:
+                child_keys = index_keys(child)
+                if child_keys is None:
+                    return None
+                keys.update(child_keys)
+            return keys
+        elif trigger.attribute == 'all':
+            # Every child must match, so the keys of any one of them will do.
+            # Pick the most selective one.
+            candidates = [index_keys(child) for child in trigger.children]
+            candidates = [keys for keys in candidates if keys is not None]
+            if not candidates:
+                return None
+            return min(candidates, key=len)
+        else:
+            return None
+    elif trigger.attribute == 'topic':
+        # An empty suffix matches everything; don't bother indexing that.
+        if isinstance(trigger.expected_value, str) and trigger.expected_value:
+            return set([('topic', trigger.expected_value)])
+    elif trigger.attribute == 'category':
+        if isinstance(trigger.expected_value, str):
+            return set([('category', trigger.expected_value)])
+    elif trigger.attribute == 'field':
+        # Exact comparisons can be looked up.  contains and regex can't.
+        if trigger.comparison == 'equals':
+            values = [trigger.operand]
+        elif trigger.comparison == 'in':
+            values = trigger.operand
+        else:
+            return None
+        if not all([_hashable(value) for value in values]):
+            return None
+        return set([('field', trigger.path, value) for value in values])
+    elif trigger.attribute == 'contains':
+        # The empty string is in every message.
+        if all(trigger.patterns):
+            return set([('contains', pattern) for pattern in trigger.patterns])
+    return None
+
+
+class PatternMatcher(object):
+    """ Find which of a set of substrings occur in a piece of text.
+
+    With pyahocorasick installed, this is an Aho-Corasick automaton which
+    finds them all in one pass over the text.  Without it, we fall back to
+    checking each distinct pattern in turn.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = sorted(set(patterns))
+        self.automaton = None
+        if ahocorasick and self.patterns:
+            self.automaton = ahocorasick.Automaton()
+            for pattern in self.patterns:
+                self.automaton.add_word(pattern, pattern)
+            self.automaton.make_automaton()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def search(self, text):
+        """ Return the set of patterns found in the text. """
+        if self.automaton is not None:
+            return set([pattern for end, pattern in self.automaton.iter(text)])
+        return set([pattern for pattern in self.patterns if pattern in text])
+
+
+class RuleIndex(object):
+    """ Map topic suffixes, categories and fields to the rules they trigger.
+
+    ``candidates(msg)`` returns, in their original order, a subset of the
+    rules which is guaranteed to contain every rule whose trigger matches the
+    message.  It gives the same awards as walking the whole list.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.by_topic = {}
+        self.by_category = {}
+        self.by_pattern = {}
+        self.by_field = {}
+        self.unindexed = []
+
+        for position, rule in enumerate(self.rules):
+            keys = index_keys(rule.trigger)
+            if keys is None:
+                self.unindexed.append(position)
+                continue
+            for key in keys:
+                if key[0] == 'topic':
+                    table = self.by_topic
+                elif key[0] == 'category':
+                    table = self.by_category
+                elif key[0] == 'contains':
+                    table = self.by_pattern
+                else:
+                    table = self.by_field.setdefault(key[1], {})
+                table.setdefault(key[-1], []).append(position)
+
+        # Topic triggers match on suffix.  Rather than trying every suffix of
+        # an incoming topic, only try the lengths we know about.
+        self.suffix_lengths = sorted(set(len(s) for s in self.by_topic))
+
+        # All the 'contains' triggers of the ruleset are checked in one go.
+        self.matcher = PatternMatcher(self.by_pattern)
+
+        self.accessors = [
+            (path_accessor(path), table)
+            for path, table in self.by_field.items()
+        ]
+
+        log.info("Indexed %i badge rules, %i of which are unindexable" % (
+            len(self.rules), len(self.unindexed)))
+
+    def __len__(self):
+        return len(self.rules)
+
+    def candidates(self, msg, subs=None):
+        """ Return the rules whose triggers might match this message.
+
+        ``subs`` is the ``Substitutions`` view of the message, whose cached
+        serialization is shared with the ``contains`` triggers themselves.
+        """
+        topic = msg.get('topic')
+        if not isinstance(topic, str):
+            # Something odd.  Let the triggers themselves sort it out.
+            return list(self.rules)
+
+        positions = set(self.unindexed)
+
+        for length in self.suffix_lengths:
+            if length > len(topic):
+                break
+            positions.update(self.by_topic.get(topic[-length:], []))
+
+        parts = topic.split('.', 4)
+        if len(parts) > 3:
+            positions.update(self.by_category.get(parts[3], []))
+
+        if self.matcher:
+            if subs is None:
+                subs = Substitutions(msg)
+            try:
+                found = self.matcher.search(subs.serialized)
+            except Exception as e:
+                # Then none of the 'contains' triggers can match either.
+                log.exception(e)
+                found = []
+            for pattern in found:
+                positions.update(self.by_pattern[pattern])
+
+        for access, table in self.accessors:
+            try:
+                value = access(msg)
+            except (KeyError, IndexError, TypeError):
+                continue
+            if _hashable(value):
+                positions.update(table.get(value, []))
+
+        return [self.rules[position] for position in sorted(positions)]
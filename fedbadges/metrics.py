@@ -0,0 +1,187 @@
+# -*- coding; utf-8 -*-
+""" Timings and counters for the stages of evaluating a BadgeRule.
+
+Every stage a rule goes through for a message (trigger, recipients, the
+Badgr assertion check, criteria, datanommer, FAS, award) records how long it
+took in ``stage_seconds`` and how it came out in ``stage_total``, both
+labelled by rule name.  They are rendered in the Prometheus text exposition
+format, and served over HTTP if the consumer is given a port.
+
+Recording is a dictionary lookup and a few additions under a lock, and
+nothing at all unless ``enabled`` is set.
+"""
+
+import bisect
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import logging
+log = logging.getLogger("moksha.hub")
+
+
+# The consumer turns this on with the 'badges.metrics.enabled' option.
+enabled = False
+
+# Seconds.  Badgr, datanommer and FAS calls sit somewhere in the middle.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+clock = time.monotonic
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        ['%s="%s"' % (name, _escape(value)) for name, value in pairs])
+
+
+class Counter(object):
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s counter' % self.name]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append('%s%s %s' % (
+                self.name, _labels(self.labels, labels), value))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (not cumulative)..., +Inf, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-1] += value
+
+    def count(self, labels):
+        values = self._values.get(labels)
+        if values is None:
+            return 0
+        return sum(values[:-1])
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        with self._lock:
+            values = sorted([(k, list(v)) for k, v in self._values.items()])
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %i' % (
+                    self.name,
+                    _labels(self.labels, labels, [('le', bound)]),
+                    cumulative))
+            lines.append('%s_sum%s %s' % (
+                self.name, _labels(self.labels, labels), counts[-1]))
+            lines.append('%s_count%s %i' % (
+                self.name, _labels(self.labels, labels), cumulative))
+        return lines
+
+
+stage_seconds = Histogram(
+    'fedbadges_stage_seconds',
+    'Time spent in each stage of evaluating a badge rule.',
+    ('rule', 'stage'),
+)
+stage_total = Counter(
+    'fedbadges_stage_total',
+    'How each stage of evaluating a badge rule turned out.',
+    ('rule', 'stage', 'outcome'),
+)
+
+request_seconds = Histogram(
+    'fedbadges_request_seconds',
+    'Time spent in each request to another service.',
+    ('service', 'method', 'outcome'),
+)
+
+metrics = [stage_seconds, stage_total, request_seconds]
+
+
+def observe(rule, stage, start, outcome):
+    """ Record that a stage, begun at ``start``, came to ``outcome``.
+
+    ``outcome`` is 'hit' if the rule goes on past this stage, 'skip' if it
+    stops here, or 'error'.  Other stages may have outcomes of their own.
+    """
+    if not enabled:
+        return
+    stage_seconds.observe((rule, stage), clock() - start)
+    stage_total.inc((rule, stage, outcome))
+
+
+def observe_request(service, method, start, outcome):
+    """ Record that a request to ``service``, begun at ``start``, came to
+    ``outcome``, which is 'hit' or 'error'. """
+    if not enabled:
+        return
+    request_seconds.observe((service, method, outcome), clock() - start)
+
+
+def render():
+    """ Return all our metrics in the Prometheus text format. """
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("metrics: " + format % args)
+
+
+def serve(port, address=''):
+    """ Serve our metrics over HTTP from a background thread. """
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='fedbadges-metrics')
+    thread.daemon = True
+    thread.start()
+    log.info("Serving metrics on %s:%i" % (address or '*', port))
+    return server
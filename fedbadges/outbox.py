@@ -0,0 +1,83 @@
+# -*- coding; utf-8 -*-
+""" A durable record of the badges we mean to award.
+
+Every award is written to the ``AwardOutbox``, a small SQLite database,
+before Badgr is asked to issue it, and marked done once Badgr has (or once
+we find the person already has the badge).  If Badgr is down long enough
+for the award writer to give up, or fedbadges is stopped with awards still
+queued, the awards that were never done are still there at the next start,
+and are submitted again.  Awarding checks whether the badge is already held,
+so replaying one that did go through in the end is harmless.
+"""
+
+import sqlite3
+import threading
+import time
+
+import logging
+log = logging.getLogger("moksha.hub")
+
+
+class AwardOutbox(object):
+    """ The awards we have yet to see through, in a SQLite file. """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS awards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            badge_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            link TEXT,
+            created REAL NOT NULL,
+            done REAL
+        )
+    """
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(self.schema)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def record(self, badge_id, username, link=None):
+        """ Write down an award we're about to make, and return its id. """
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT INTO awards (badge_id, username, link, created) '
+                'VALUES (?, ?, ?, ?)',
+                (badge_id, username, link, self.clock()))
+            return cursor.lastrowid
+
+    def done(self, entry):
+        with self._lock:
+            self._db.execute('UPDATE awards SET done = ? WHERE id = ?',
+                             (self.clock(), entry))
+
+    def pending(self):
+        """ Return ``(id, badge_id, username, link)`` of every award not
+        done, oldest first. """
+        with self._lock:
+            return self._db.execute(
+                'SELECT id, badge_id, username, link FROM awards '
+                'WHERE done IS NULL ORDER BY id').fetchall()
+
+    def compact(self):
+        """ Forget the awards that are done. """
+        with self._lock:
+            cursor = self._db.execute(
+                'DELETE FROM awards WHERE done IS NOT NULL')
+            return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            total, pending = self._db.execute(
+                'SELECT COUNT(*), COUNT(*) - COUNT(done) FROM awards'
+            ).fetchone()
+        return dict(size=total, pending=pending)
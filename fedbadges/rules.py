@@ -8,13 +8,18 @@ Authors:    Ralph Bean
 """
 
 import abc
-import copy
+import collections
+import contextlib
 import json
 import types
 import functools
 import inspect
 import transaction
 import re
+import threading
+import time
+
+import sqlalchemy
 
 import fedmsg.config
 import fedmsg.meta
@@ -22,17 +27,24 @@ import fedmsg.encoding
 import datanommer.models
 
 from badgrclient import BadgeClass
+import fedbadges.metrics as metrics
+from fedbadges.aliases import AliasMap
+from fedbadges.assertions import AssertionIndex
+from fedbadges.cache import CriteriaCache, missing
+from fedbadges.counters import CounterStore
 from fedbadges.utils import (
     # These are all in-process utilities
-    construct_substitutions,
-    format_args,
+    Substitutions,
+    Template,
+    path_accessor,
+    compile_lambda,
+    cached_lambda,
     single_argument_lambda_factory,
-    recursive_lambda_factory,
     graceful,
     get_pagure_authors,
 
     # These make networked API calls
-    user_exists_in_fas,
+    users_exist_in_fas,
     assertion_exists,
     get_fasjson_session,
 )
@@ -55,14 +67,22 @@ except ImportError as e:
     log.warn("Could not import email2fas: %r" % e)
 
 # Match OpenID agent strings, i.e. http://FAS.id.fedoraproject.org
+openid_pattern = re.compile(
+    '^https?://([a-z][a-z0-9]+)\.id\.fedoraproject\.org$')
+github_pattern = re.compile(
+    '^https?://api.github.com/users/([a-z][a-z0-9-]+)$')
+distgit_pattern = re.compile(
+    '^https?://src.fedoraproject.org/user/([a-z][a-z0-9]+)$')
+
+
 def openid2fas(openid, **config):
-    m = re.search('^https?://([a-z][a-z0-9]+)\.id\.fedoraproject\.org$', openid)
+    m = openid_pattern.search(openid)
     if m:
         return m.group(1)
     return openid
 
 def github2fas(uri, **config):
-    m = re.search('^https?://api.github.com/users/([a-z][a-z0-9-]+)$', uri)
+    m = github_pattern.search(uri)
     if not m:
         return uri
     github_username = m.group(1)
@@ -79,7 +99,7 @@ def github2fas(uri, **config):
     return result["result"][0]["username"]
 
 def distgit2fas(uri, **config):
-    m = re.search('^https?://src.fedoraproject.org/user/([a-z][a-z0-9]+)$', uri)
+    m = distgit_pattern.search(uri)
     if m:
         return m.group(1)
     return uri
@@ -89,6 +109,105 @@ def krb2fas(name, **config):
         return name
     return name.split("/")[0]
 
+# Usernames from other systems that we already know the FAS username for.
+# The consumer loads this up if it's configured to.
+alias_map = AliasMap()
+
+# Who has been awarded which badge.  The consumer loads this from Badgr if
+# it's configured to; until then, we ask Badgr about each awardee.
+assertion_index = AssertionIndex()
+
+
+class RecipientPipeline(object):
+    """ Turn the would-be recipients of a badge into FAS usernames.
+
+    It is built once per rule from the names of its ``recipient_*2fas``
+    flags, in the order they are always applied.  Conversions which only
+    parse the recipient are composed into one function run in a single pass;
+    those which may look people up (``nick2fas``, ``email2fas``,
+    ``github2fas``) go through the ``alias_map`` in one batch.  Anyone who
+    ends up as None, is banned or looks like an internal IP address is
+    dropped on the way out.
+    """
+
+    # name: (alias kind, or None for local conversions)
+    conversions = collections.OrderedDict([
+        ('nick2fas', 'nick'),
+        ('email2fas', 'email'),
+        ('openid2fas', None),
+        ('github2fas', 'github'),
+        ('distgit2fas', None),
+        ('krb2fas', None),
+    ])
+
+    ip_prefixes = ('192.168.', '10.')
+
+    def __init__(self, steps=(), banned=frozenset()):
+        unknown = set(steps).difference(self.conversions)
+        if unknown:
+            raise KeyError("%r are not recipient conversions.  Choose from %r"
+                           % (sorted(unknown), list(self.conversions)))
+        self.steps = [name for name in self.conversions if name in steps]
+        self.banned = frozenset(banned)
+
+        # Group consecutive local conversions together.
+        self.stages = []
+        local = []
+        for name in self.steps:
+            kind = self.conversions[name]
+            if kind is None:
+                local.append(name)
+                continue
+            if local:
+                self.stages.append(self._local_stage(local))
+                local = []
+            self.stages.append(self._alias_stage(kind, name))
+        if local:
+            self.stages.append(self._local_stage(local))
+
+    @classmethod
+    def from_rule(cls, badge_dict, banned=frozenset()):
+        steps = []
+        if badge_dict.get('recipient'):
+            steps = [name for name in cls.conversions
+                     if badge_dict.get('recipient_' + name)]
+        return cls(steps, banned)
+
+    @staticmethod
+    def _local_stage(names):
+        functions = [globals()[name] for name in names]
+
+        def convert(value):
+            for function in functions:
+                value = function(value, **fedmsg_config)
+                if value is None:
+                    break
+            return value
+
+        def stage(values):
+            return [convert(value) for value in values]
+        return stage
+
+    @staticmethod
+    def _alias_stage(kind, name):
+        def stage(values):
+            return alias_map.resolve(kind, values, globals()[name],
+                                     fedmsg_config)
+        return stage
+
+    def __call__(self, recipients):
+        """ Return the frozenset of FAS usernames for these recipients. """
+        values = set(recipients)
+        for stage in self.stages:
+            values.discard(None)
+            values = set(stage(list(values)))
+        values.discard(None)
+        ip_prefixes = self.ip_prefixes
+        return frozenset([
+            user for user in values.difference(self.banned)
+            if not user.startswith(ip_prefixes)
+        ])
+
 operators = frozenset([
     "all",
     "any",
@@ -108,6 +227,19 @@ fedmsg_config = fedmsg.config.load_config()
 fedmsg.meta.make_processors(**fedmsg_config)
 
 
+def create_badge_class(client, badge_dict, issuer_id):
+    """ Create the badge class a rule awards in Badgr, and return its id. """
+    badge = BadgeClass(client).create(
+        name=badge_dict['name'],
+        image='TODO',
+        description=badge_dict['description'],
+        issuer_eid=issuer_id,
+        criteria_url=badge_dict['discussion'],
+        tags=badge_dict.get('tags', []),
+    )
+    return badge.entityId
+
+
 class BadgeRule(object):
     required = frozenset([
         'name',
@@ -140,53 +272,39 @@ class BadgeRule(object):
         'taskotron',
     ])
 
-    def __init__(self, badge_dict, badgr_client, issuer_id):
-        argued_fields = frozenset(list(badge_dict.keys()))
-
-        if not argued_fields.issubset(self.possible):
-            raise KeyError(
-                "%r are not possible fields.  Choose from %r" % (
-                    argued_fields.difference(self.possible),
-                    self.possible
-                ))
-
-        if not self.required.issubset(argued_fields):
-            raise ValueError(
-                "BadgeRule requires %r.  Missing %r" % (
-                    self.required,
-                    self.required.difference(argued_fields),
-                ))
+    def __init__(self, badge_dict, badgr_client, issuer_id, badge_id=None):
+        self.check_fields(badge_dict)
 
         self._d = badge_dict
         self.client = badgr_client
         self.issuer_id = issuer_id
 
-        if self.client:
+        if self.client and badge_id:
+            # The consumer already looked it up (or made it) for us.
+            self.badge_id = badge_id
+        elif self.client:
             badge_name = self._d['name']
             badge_id = self.client.get_eid_from_badge_name(badge_name, issuer_id)
             if badge_id:
                 self.badge_id = badge_id
             else:
-                badge = BadgeClass(self.client).create(
-                    name=badge_name,
-                    image='TODO',
-                    description=self._d['description'],
-                    issuer_eid=self.issuer_id,
-                    criteria_url=self._d['discussion'],
-                    tags=self._d.get('tags', []),
-                )
-
-                self.badge_id = badge.entityId
+                self.badge_id = create_badge_class(
+                    self.client, self._d, self.issuer_id)
 
         self.trigger = Trigger(self._d['trigger'], self)
+        self._trigger = self.trigger.compile()
         self.criteria = Criteria(self._d['criteria'], self)
         self.recipient_key = self._d.get('recipient')
+        if self.recipient_key:
+            self.recipient = Template(self.recipient_key, lambdas=False)
         self.recipient_nick2fas = self._d.get('recipient_nick2fas')
         self.recipient_email2fas = self._d.get('recipient_email2fas')
         self.recipient_openid2fas = self._d.get('recipient_openid2fas')
         self.recipient_github2fas = self._d.get('recipient_github2fas')
         self.recipient_distgit2fas = self._d.get('recipient_distgit2fas')
         self.recipient_krb2fas = self._d.get('recipient_krb2fas')
+        self.recipients = RecipientPipeline.from_rule(
+            self._d, self.banned_usernames)
 
         # A sanity check before we kick things off.
         if self.recipient_nick2fas and not nick2fas:
@@ -197,25 +315,76 @@ class BadgeRule(object):
             raise ImportError("recipient_email2fas specified, but "
                               "email2fas is not available.")
 
+    @classmethod
+    def check_fields(cls, badge_dict):
+        """ Raise if a rule definition has fields it shouldn't, or lacks
+        some it should. """
+        argued_fields = frozenset(list(badge_dict.keys()))
+
+        if not argued_fields.issubset(cls.possible):
+            raise KeyError(
+                "%r are not possible fields.  Choose from %r" % (
+                    argued_fields.difference(cls.possible),
+                    cls.possible
+                ))
+
+        if not cls.required.issubset(argued_fields):
+            raise ValueError(
+                "BadgeRule requires %r.  Missing %r" % (
+                    cls.required,
+                    cls.required.difference(argued_fields),
+                ))
+
     def __getitem__(self, key):
         return self._d[key]
 
     def __repr__(self):
         return "<fedbadges.models.BadgeRule: %r>" % self._d
 
-    def matches(self, msg):
+    def trigger_matches(self, msg, subs=None):
+        """ Check our compiled trigger against a message.
+
+        This is the one place errors from the trigger are caught.  Anything
+        that goes wrong means that the trigger does not match.
+        """
+        if subs is None:
+            subs = Substitutions(msg)
+        start = metrics.clock()
+        try:
+            matched = self._trigger(msg, subs)
+        except Exception as e:
+            log.exception(e)
+            log.error("From trigger of rule %r, msg %r" % (
+                self._d.get('name'), msg))
+            matched = False
+        metrics.observe(self._d['name'], 'trigger', start,
+                        'hit' if matched else 'skip')
+        return matched
+
+    def matches(self, msg, subs=None, triggered=False):
+        """ Return the set of users who should be awarded for this message.
+
+        ``subs`` is the ``Substitutions`` view of the message.  The consumer
+        builds one per message and shares it between every rule; if it isn't
+        given, we build our own.  With ``triggered``, the caller has already
+        checked that our trigger matches the message.
+        """
+
+        if subs is None:
+            subs = Substitutions(msg)
+        name = self._d['name']
 
         # First, do a lightweight check to see if the msg matches a pattern.
-        if not self.trigger.matches(msg):
+        if not triggered and not self.trigger_matches(msg, subs):
             return set()
 
         # Before proceeding further, let's see who would get this badge if
         # our more heavyweight checks matched up.  If the user specifies a
         # recipient_key, we can use that to extract the potential awardee.  If
         # that is not specified, we just use `msg2usernames`.
+        start = metrics.clock()
         if self.recipient_key:
-            subs = construct_substitutions(msg)
-            obj = format_args(self.recipient_key, subs)
+            obj = self.recipient.render(subs, msg)
 
             if isinstance(obj, (str, int, float)):
                 obj = [obj]
@@ -238,66 +407,36 @@ class BadgeRule(object):
             if new_obj:
                 obj = new_obj
 
-            awardees = frozenset(obj)
-
-            if self.recipient_nick2fas:
-                awardees = frozenset([
-                    nick2fas(nick, **fedmsg_config) for nick in awardees
-                ])
-
-            if self.recipient_email2fas:
-                awardees = frozenset([
-                    email2fas(email, **fedmsg_config) for email in awardees
-                ])
-
-            if self.recipient_openid2fas:
-                awardees = frozenset([
-                    openid2fas(openid, **fedmsg_config) for openid in awardees
-                ])
-
-            if self.recipient_github2fas:
-                awardees = frozenset([
-                    github2fas(uri, **fedmsg_config) for uri in awardees
-                ])
-
-            if self.recipient_distgit2fas:
-                awardees = frozenset([
-                    distgit2fas(uri, **fedmsg_config) for uri in awardees
-                ])
-
-            if self.recipient_krb2fas:
-                awardees = frozenset([
-                    krb2fas(uri, **fedmsg_config) for uri in awardees
-                ])
-
-            awardees = frozenset([e for e in awardees if e is not None])
+            awardees = self.recipients(obj)
         else:
-            awardees = fedmsg.meta.msg2usernames(msg)
-
-        awardees = awardees.difference(self.banned_usernames)
-
-        # Strip anyone who is an IP address
-        awardees = frozenset([
-            user for user in awardees if not (
-                user.startswith('192.168.') or
-                user.startswith('10.')
-            )
-        ])
+            awardees = self.recipients(fedmsg.meta.msg2usernames(msg))
 
         # If no-one would get the badge by default, then no reason to waste
         # time doing any further checks.  No need to query the Tahrir DB.
         if not awardees:
+            metrics.observe(name, 'recipients', start, 'skip')
             return awardees
+        metrics.observe(name, 'recipients', start, 'hit')
 
         # Limit awardees to only those who do not already have this badge.
         # Do this only if we have an active connection to the Tahrir DB.
         if self.client:
-            badge = BadgeClass(self.client, eid=self.badge_id)
-            awardees = frozenset([
-                user for user in awardees
-                if not assertion_exists(
-                    badge, "%s@fedoraproject.org" % user
-                )])
+            start = metrics.clock()
+            if assertion_index.enabled:
+                awardees = frozenset([
+                    user for user in awardees
+                    if not assertion_index.has(
+                        self.badge_id, "%s@fedoraproject.org" % user
+                    )])
+            else:
+                badge = BadgeClass(self.client, eid=self.badge_id)
+                awardees = frozenset([
+                    user for user in awardees
+                    if not assertion_exists(
+                        badge, "%s@fedoraproject.org" % user
+                    )])
+            metrics.observe(name, 'assertion', start,
+                            'hit' if awardees else 'skip')
 
         # If no-one would get the badge at this point, then no reason to waste
         # time doing any further checks.  No need to query datanommer.
@@ -305,19 +444,23 @@ class BadgeRule(object):
             return awardees
 
         # Check our backend criteria -- likely, perform datanommer queries.
+        start = metrics.clock()
         try:
-            if not self.criteria.matches(msg):
+            if not self.criteria.matches(msg, subs):
+                metrics.observe(name, 'criteria', start, 'skip')
                 return set()
         except IOError as e:
             log.exception(e)
+            metrics.observe(name, 'criteria', start, 'error')
             return set()
+        metrics.observe(name, 'criteria', start, 'hit')
 
         # Lastly, and this is probably most expensive.  Make sure the person
         # actually has a FAS account before we award anything.
         # https://github.com/fedora-infra/tahrir/issues/225
-        awardees = set([
-            u for u in awardees if user_exists_in_fas(fedmsg_config, u)
-        ])
+        start = metrics.clock()
+        awardees = users_exist_in_fas(fedmsg_config, awardees)
+        metrics.observe(name, 'fas', start, 'hit' if awardees else 'skip')
 
         return awardees
 
@@ -385,19 +528,191 @@ class Trigger(AbstractTopLevelComparator):
     possible = frozenset([
         'topic',
         'category',
+        'field',
+        'contains',
     ]).union(operators).union(lambdas)
 
+    field_comparisons = frozenset([
+        'equals',
+        'in',
+        'contains',
+        'regex',
+    ])
+
+    def __init__(self, *args, **kwargs):
+        super(Trigger, self).__init__(*args, **kwargs)
+
+        # Compile lambdas once, now, rather than for every message.
+        if self.attribute == 'lambda':
+            self.function = compile_lambda(self.expected_value, name='msg')
+        elif self.attribute == 'field':
+            self.predicate = self._compile_field()
+        elif self.attribute == 'contains':
+            # Like 'lambda: "foo" in json.dumps(msg)', but the serialization
+            # is done once per message and shared between all rules.
+            self.patterns = self.expected_value
+            if isinstance(self.patterns, str):
+                self.patterns = [self.patterns]
+            if not isinstance(self.patterns, list) or \
+                    not all([isinstance(p, str) for p in self.patterns]):
+                raise TypeError("contains only accepts strings, not %r" %
+                                self.expected_value)
+
+    def _compile_field(self):
+        """ Build the predicate for a ``field`` trigger.
+
+        These look like ``field: {path: msg.agent, equals: ralph}`` and compare
+        the raw value found at a dotted path in the message, without
+        serializing it.  Exactly one of equals, in, contains or regex must be
+        given.  The predicate is False if the path isn't in the message.
+        """
+        spec = self.expected_value
+        if not isinstance(spec, dict) or 'path' not in spec:
+            raise ValueError("Field triggers need a path.  Got %r" % spec)
+
+        comparisons = frozenset(spec.keys()).difference(['path'])
+        if len(comparisons) != 1 or \
+                not comparisons.issubset(self.field_comparisons):
+            raise ValueError("Field triggers need exactly one of %r.  Got %r"
+                             % (self.field_comparisons, spec))
+
+        self.path = spec['path']
+        self.comparison = list(comparisons)[0]
+        self.operand = operand = spec[self.comparison]
+        access = path_accessor(self.path)
+
+        if self.comparison == 'equals':
+            compare = lambda value: value == operand
+        elif self.comparison == 'in':
+            if not isinstance(operand, list):
+                raise TypeError("Field 'in' only accepts lists, not %r" %
+                                type(operand))
+            compare = lambda value: value in operand
+        elif self.comparison == 'contains':
+            compare = lambda value: operand in value
+        else:
+            try:
+                pattern = re.compile(operand)
+            except (re.error, TypeError) as e:
+                raise ValueError("Invalid regex %r: %s" % (operand, e))
+            compare = lambda value: isinstance(value, str) and \
+                pattern.search(value) is not None
+
+        def predicate(msg):
+            try:
+                return compare(access(msg))
+            except (KeyError, IndexError, TypeError):
+                return False
+        return predicate
+
+    def compile(self):
+        """ Compile this trigger tree into a single callable.
+
+        The callable gives the same answer as ``matches`` but doesn't walk
+        the tree or guard every node.  Only lambdas, which may raise on
+        unexpected messages, still get a guard of their own, so that ``not``
+        and ``any`` treat their failure as a non-match the way the tree does.
+        ``matches`` is kept around as the reference implementation.
+        """
+        if self.children:
+            compiled = [child.compile() for child in self.children]
+
+            if self.attribute == 'any':
+                suffixes = tuple([
+                    child.expected_value for child in self.children
+                    if child.attribute == 'topic'
+                    and isinstance(child.expected_value, str)
+                ])
+                if len(suffixes) == len(self.children):
+                    # A common case:  any one of a list of topics.
+                    def matches(msg, subs):
+                        topic = msg.get('topic')
+                        if isinstance(topic, str):
+                            return topic.endswith(suffixes)
+                        return False
+                    return matches
+
+                def matches(msg, subs):
+                    for child in compiled:
+                        if child(msg, subs):
+                            return True
+                    return False
+            elif self.attribute == 'all':
+                def matches(msg, subs):
+                    for child in compiled:
+                        if not child(msg, subs):
+                            return False
+                    return True
+            else:
+                def matches(msg, subs):
+                    for child in compiled:
+                        if child(msg, subs):
+                            return False
+                    return True
+            return matches
+
+        expected = self.expected_value
+        if self.attribute == 'lambda':
+            function = self.function
+
+            def matches(msg, subs):
+                try:
+                    return function(msg)
+                except Exception as e:
+                    log.exception(e)
+                    log.error("From trigger: %r msg: %r" % (self, msg))
+                    return False
+        elif self.attribute == 'field':
+            predicate = self.predicate
+
+            def matches(msg, subs):
+                return predicate(msg)
+        elif self.attribute == 'contains':
+            patterns = self.patterns
+
+            def matches(msg, subs):
+                try:
+                    serialized = subs.serialized
+                except Exception as e:
+                    log.exception(e)
+                    return False
+                for pattern in patterns:
+                    if pattern in serialized:
+                        return True
+                return False
+        elif self.attribute == 'category' and isinstance(expected, str):
+            def matches(msg, subs):
+                topic = msg.get('topic')
+                if not isinstance(topic, str):
+                    return False
+                parts = topic.split('.', 4)
+                return len(parts) > 3 and parts[3] == expected
+        elif self.attribute == 'topic' and isinstance(expected, str):
+            def matches(msg, subs):
+                topic = msg.get('topic')
+                if isinstance(topic, str):
+                    return topic.endswith(expected)
+                return topic == expected
+        else:
+            # Something unusual.  Fall back to the tree walker for this node.
+            matches = self.matches
+        return matches
+
     @graceful(set())
-    def matches(self, msg):
+    def matches(self, msg, subs=None):
         # Check if we should just aggregate the results of our children.
         # Otherwise, we are a leaf-node doing a straightforward comparison.
         if self.children:
             return operator_lookup[self.attribute]((
-                child.matches(msg) for child in self.children
+                child.matches(msg, subs) for child in self.children
             ))
         elif self.attribute == 'lambda':
-            return single_argument_lambda_factory(
-                expression=self.expected_value, argument=msg, name='msg')
+            return self.function(msg)
+        elif self.attribute == 'field':
+            return self.predicate(msg)
+        elif self.attribute == 'contains':
+            serialized = json.dumps(msg)
+            return any([pattern in serialized for pattern in self.patterns])
         elif self.attribute == 'category':
             # TODO -- use fedmsg.meta.msg2processor(msg).__name__.lower()
             return msg['topic'].split('.')[3] == self.expected_value
@@ -408,6 +723,12 @@ class Trigger(AbstractTopLevelComparator):
                 return msg[self.attribute] == self.expected_value
 
 
+# When this is on, the children of any/all criteria are always checked in
+# the order they are written in, rather than cheapest first.  The consumer
+# sets it from the 'badges.criteria.pin_order' option.
+pin_criteria_order = False
+
+
 class Criteria(AbstractTopLevelComparator):
     possible = frozenset([
         'datanommer',
@@ -419,28 +740,142 @@ class Criteria(AbstractTopLevelComparator):
         if not self.children:
             # Then, by AbstractComparator rules, I am a leaf node.  Specialize!
             self._specialize()
+        else:
+            # For each child: how often it was checked, for how long in all,
+            # and how often its answer settled the matter for us.  Every
+            # thread evaluating this rule updates them, under the lock.
+            self.child_stats = [[0, 0.0, 0] for child in self.children]
+            self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def _child_cost(stats):
+        """ The expected time a child takes per decisive answer. """
+        calls, seconds, decisive = stats
+        if not calls:
+            # Try everything at least once.
+            return 0.0
+        return (seconds / calls) * (calls + 2.0) / (decisive + 1.0)
+
+    def ordered_children(self):
+        """ Return our children, with their indices, in the order to check
+        them.  That is cheapest and most decisive first, unless pinned.
+        """
+        children = list(enumerate(self.children))
+        if pin_criteria_order:
+            return children
+        with self._stats_lock:
+            costs = [self._child_cost(stats) for stats in self.child_stats]
+        return sorted(children, key=lambda item: costs[item[0]])
+
+    def _short_circuit(self, msg, subs):
+        # any() is decided by the first True, all() by the first False.
+        decisive = self.attribute == 'any'
+        for index, child in self.ordered_children():
+            start = time.monotonic()
+            result = bool(child.matches(msg, subs))
+            elapsed = time.monotonic() - start
+            with self._stats_lock:
+                stats = self.child_stats[index]
+                stats[0] += 1
+                stats[1] += elapsed
+                if result == decisive:
+                    stats[2] += 1
+            if result == decisive:
+                return decisive
+        return not decisive
 
     def _specialize(self):
         if self.attribute == 'datanommer':
-            self.specialization = DatanommerCriteria(self.expected_value)
+            self.specialization = DatanommerCriteria(
+                self.expected_value, self)
         # TODO -- expand this with other "backends" as necessary
         # elif self.attribute == 'fas'
         else:
             raise RuntimeError("This should be impossible to reach.")
 
     @graceful(set())
-    def matches(self, msg):
+    def matches(self, msg, subs=None):
+        if subs is None:
+            subs = Substitutions(msg)
         if self.children:
+            if self.attribute in ('any', 'all'):
+                return self._short_circuit(msg, subs)
             return operator_lookup[self.attribute]((
-                child.matches(msg) for child in self.children
+                child.matches(msg, subs) for child in self.children
             ))
         else:
-            return self.specialization.matches(msg)
+            return self.specialization.matches(msg, subs)
 
 
 class AbstractSpecializedComparator(AbstractComparator):
     pass
 
+
+# Results of datanommer queries, shared between all the rules.  The consumer
+# turns this on and tells it about incoming messages; see CriteriaCache.
+criteria_cache = CriteriaCache()
+
+# Only plain values are worth keeping.  A query object or a list of
+# messages would pin a database session.
+cacheable = (bool, int, float, str, type(None))
+
+# When this is on, count criteria stop counting once they know the answer.
+# The consumer sets it from the 'badges.bounded_counts' option.
+bounded_counts = False
+
+# How many datanommer queries may run at once, across all threads.  The
+# consumer replaces this with a semaphore if it's given a budget.  Each
+# thread's session hands its connection back to the pool once its query
+# is done.
+datanommer_budget = contextlib.nullcontext()
+
+# Our own per-user message counts.  The consumer seeds this and keeps it up
+# to date, if so configured, and it answers what counts it can.
+counter_store = CounterStore()
+
+
+def bounded_count(kwargs, limit):
+    """ Count the messages matching a datanommer filter, up to ``limit``. """
+    Message = datanommer.models.Message
+    query = Message.make_query(**kwargs)
+    query = query.with_only_columns(Message.id).limit(limit).subquery()
+    return datanommer.models.session.scalar(
+        sqlalchemy.select(sqlalchemy.func.count()).select_from(query))
+
+
+def share_count_limits(rules):
+    """ Give the count criteria of these rules that share a filter one limit.
+
+    Each count criteria knows how far it needs to count (or that it needs
+    the exact count).  Rules which share a filter, like the levels of a badge
+    series, then count as far as the highest of them needs, or exactly if
+    any of them does, so that they can share the query too.  Returns the
+    limit of each filter.
+    """
+    found = []
+    for rule in rules:
+        stack = [rule.criteria]
+        while stack:
+            criteria = stack.pop()
+            if criteria.children:
+                stack.extend(criteria.children)
+                continue
+            specialization = criteria.specialization
+            if getattr(specialization, 'filter_key', None) is not None:
+                found.append(specialization)
+
+    limits = {}
+    for criteria in found:
+        current = limits.get(criteria.filter_key, criteria.count_limit)
+        if current is None or criteria.count_limit is None:
+            limits[criteria.filter_key] = None
+        else:
+            limits[criteria.filter_key] = max(current, criteria.count_limit)
+    for criteria in found:
+        criteria.shared_count_limit = limits[criteria.filter_key]
+    return limits
+
+
 class DatanommerCriteria(AbstractSpecializedComparator):
     required = possible = frozenset([
         'filter',
@@ -466,6 +901,22 @@ class DatanommerCriteria(AbstractSpecializedComparator):
         'lambda': single_argument_lambda_factory,
     }
 
+    # How far past the threshold we must count for each condition to give
+    # the same answer as the exact count.
+    count_limit_offsets = {
+        'is greater than or equal to': 0,
+        'greater than or equal to': 0,
+        'less than': 0,
+
+        'greater than': 1,
+        'is less than or equal to': 1,
+        'less than or equal to': 1,
+        'equal to': 1,
+        'is equal to': 1,
+        'is not': 1,
+        'is not equal to': 1,
+    }
+
     def __init__(self, *args, **kwargs):
         super(DatanommerCriteria, self).__init__(*args, **kwargs)
         if len(self._d['condition']) > 1:
@@ -494,11 +945,39 @@ class DatanommerCriteria(AbstractSpecializedComparator):
                            (condition_key, list(self.condition_callbacks.keys())))
 
         # Construct a condition callable for later
-        self.condition = functools.partial(
-            self.condition_callbacks[condition_key], condition_val)
+        if condition_key == 'lambda':
+            self.condition = compile_lambda(condition_val)
+        else:
+            self.condition = functools.partial(
+                self.condition_callbacks[condition_key], condition_val)
 
-    def _construct_query(self, msg):
-        """ Construct a datanommer query for this message.
+        # Work out how far a count needs to go to satisfy the condition.
+        # share_count_limits() may raise that, to match other rules.
+        self.filter_key = self.count_limit = None
+        if self._d['operation'] == 'count':
+            self.filter_key = json.dumps(
+                self._d['filter'], sort_keys=True, default=repr)
+            offset = self.count_limit_offsets.get(condition_key)
+            if offset is not None and type(condition_val) is int \
+                    and condition_val >= 0:
+                self.count_limit = condition_val + offset
+        self.shared_count_limit = self.count_limit
+
+        # Parse the filter once, now.  This also compiles whatever lambdas we
+        # can ahead of time.  Those which contain substitutions can only be
+        # compiled once we have a message in hand.
+        self.filter = Template(self._d['filter'])
+
+        self.operation = None
+        if isinstance(self._d['operation'], dict):
+            expression = self._d['operation']['lambda']
+            if isinstance(expression, str) and '%' not in expression:
+                self.operation = compile_lambda(expression, name='query')
+            else:
+                self.operation_template = Template(expression, lambdas=False)
+
+    def _construct_kwargs(self, msg, subs):
+        """ Construct the arguments of a datanommer query for this message.
 
         The "filter" section of this criteria object will be used.  It will
         first be formatted with any substitutions present in the incoming
@@ -506,9 +985,7 @@ class DatanommerCriteria(AbstractSpecializedComparator):
         me all the messages bearing the same topic as the message that just
         arrived".
         """
-        subs = construct_substitutions(msg)
-        kwargs = format_args(copy.copy(self._d['filter']), subs)
-        kwargs = recursive_lambda_factory(kwargs, msg, name='msg')
+        kwargs = self.filter.render(subs, msg)
 
         # It is possible to recieve a list of dictionary containing the name
         # of the recipient, this is the case in the pagure's fedmsg.
@@ -521,11 +998,17 @@ class DatanommerCriteria(AbstractSpecializedComparator):
             users = get_pagure_authors(kwargs['users'])
             if users:
                 kwargs['users'] = users
-        kwargs['defer'] = True
-        total, pages, query = datanommer.models.Message.grep(**kwargs)
+        return kwargs
+
+    def _construct_query(self, msg, subs, kwargs=None):
+        """ Construct a datanommer query for this message. """
+        if kwargs is None:
+            kwargs = self._construct_kwargs(msg, subs)
+        total, pages, query = datanommer.models.Message.grep(
+            defer=True, **kwargs)
         return total, pages, query
 
-    def _format_lambda_operation(self, msg):
+    def _format_lambda_operation(self, msg, subs):
         """ Format the string representation of a lambda operation.
 
         The lambda operation can be formatted here to include strings that
@@ -533,11 +1016,9 @@ class DatanommerCriteria(AbstractSpecializedComparator):
         %(msg.comment.update_submitter)s.  Placeholders like that will have
         their value substituted with whatever appears in the incoming message.
         """
-        subs = construct_substitutions(msg)
-        operation = format_args(copy.copy(self._d['operation']), subs)
-        return operation['lambda']
+        return self.operation_template.render(subs, msg)
 
-    def matches(self, msg):
+    def matches(self, msg, subs=None):
         """ A datanommer criteria check is composed of three steps.
 
         - A datanommer query is constructed by combining our yaml definition
@@ -548,14 +1029,83 @@ class DatanommerCriteria(AbstractSpecializedComparator):
         - A condition, derived from our yaml definition, is evaluated with the
           result of the operation from the previous step and is returned.
         """
-        total, pages, query = self._construct_query(msg)
+        if subs is None:
+            subs = Substitutions(msg)
+        kwargs = self._construct_kwargs(msg, subs)
+
+        expression = None
+        if isinstance(self._d['operation'], dict):
+            if self.operation:
+                expression = self._d['operation']['lambda']
+            else:
+                expression = self._format_lambda_operation(msg, subs)
+            operation = {'lambda': expression}
+        elif self._d['operation'] == 'count' and bounded_counts and \
+                self.shared_count_limit is not None:
+            operation = {'count': self.shared_count_limit}
+        else:
+            operation = self._d['operation']
+
+        # Other rules looking at this same message may well ask the same
+        # question.  Only the first of them actually asks it.
+        result = subs.queries.get(
+            CriteriaCache.key(kwargs, operation),
+            functools.partial(self._lookup_operation,
+                              msg, subs, kwargs, operation, expression))
+        return self.condition(result)
+
+    @property
+    def rule_name(self):
+        """ The name of the BadgeRule we belong to, for our metrics. """
+        node = self
+        while isinstance(node, AbstractComparator):
+            node = node.parent
+        if node is None:
+            return None
+        return node['name']
+
+    def _lookup_operation(self, msg, subs, kwargs, operation, expression):
+        start = metrics.clock()
         if self._d['operation'] == 'count':
-            result = total
-        elif isinstance(self._d['operation'], dict):
-            expression = self._format_lambda_operation(msg)
-            result = single_argument_lambda_factory(
-                expression=expression, argument=query, name='query')
+            result = counter_store.count(kwargs)
+            if result is not None:
+                metrics.observe(self.rule_name, 'datanommer', start,
+                                'counters')
+                return result
+
+        result = criteria_cache.lookup(kwargs, operation)
+        if result is not missing:
+            metrics.observe(self.rule_name, 'datanommer', start, 'cache')
+        else:
+            since = criteria_cache.now()
+            result = None
+            with datanommer_budget:
+                try:
+                    if isinstance(operation, dict) and 'count' in operation:
+                        result = bounded_count(kwargs, operation['count'])
+                    else:
+                        result = self._run_operation(
+                            msg, subs, kwargs, expression)
+                finally:
+                    # The budget only counts queries, so give the connection
+                    # back before the next thread gets to run one.  Anything
+                    # else may still need it to load what it refers to; the
+                    # consumer gives that back once the rule is done with.
+                    if isinstance(result, cacheable):
+                        datanommer.models.session.remove()
+            if isinstance(result, cacheable):
+                criteria_cache.put(kwargs, operation, result, since)
+            metrics.observe(self.rule_name, 'datanommer', start, 'query')
+        return result
+
+    def _run_operation(self, msg, subs, kwargs, expression):
+        total, pages, query = self._construct_query(msg, subs, kwargs)
+        if self._d['operation'] == 'count':
+            return total
+        elif self.operation:
+            return self.operation(query)
+        elif expression is not None:
+            return cached_lambda(expression, name='query')(query)
         else:
             operation = getattr(query, self._d['operation'])
-            result = operation()
-        return self.condition(result)
+            return operation()
@@ -0,0 +1,87 @@
+# -*- coding; utf-8 -*-
+""" A snapshot of the ruleset, to start up faster next time.
+
+Loading the ruleset means parsing every YAML file in the rules directory
+and making sure Badgr has a badge class for each of them.  The
+``RulesetSnapshot`` keeps the result of that (the parsed definitions, in
+the order they were found, and the entity id of each badge) in a JSON file,
+under a hash of the contents of the rules directory.  When nothing in there
+has changed since, the consumer takes the definitions from the snapshot
+rather than doing all that again.
+
+Triggers and criteria hold compiled lambdas, which can't be saved, so the
+rules themselves are still built from the definitions at every start.
+"""
+
+import hashlib
+import json
+import os
+
+import logging
+log = logging.getLogger("moksha.hub")
+
+
+# Bump this whenever what goes into a snapshot changes.
+VERSION = 1
+
+
+def digest(files, issuer_id):
+    """ Hash ``(fname, content)`` pairs, in any order, for this issuer. """
+    h = hashlib.sha256()
+    h.update(('%i\0%s\0' % (VERSION, issuer_id)).encode('utf-8'))
+    for fname, content in sorted(files):
+        h.update(fname.encode('utf-8') + b'\0')
+        h.update(('%i\0' % len(content)).encode('utf-8'))
+        h.update(content)
+    return h.hexdigest()
+
+
+class RulesetSnapshot(object):
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, key):
+        """ Return ``(definitions, badge_ids)`` saved under ``key``, or None.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning("Could not read the ruleset snapshot: %r" % e)
+            return None
+        if data.get('version') != VERSION or data.get('key') != key:
+            log.info("The ruleset has changed since its last snapshot")
+            return None
+        definitions = [tuple(item) for item in data['definitions']]
+        return definitions, data['badge_ids']
+
+    def save(self, key, definitions, badge_ids):
+        # YAML can hold things JSON can't, like dates, or that it would give
+        # back changed, like mappings with keys that aren't strings.  Those
+        # rulesets are parsed afresh every time.
+        try:
+            restored = json.loads(json.dumps(definitions))
+        except Exception as e:
+            log.warning("Could not write the ruleset snapshot: %r" % e)
+            return False
+        if [tuple(item) for item in restored] != \
+                [tuple(item) for item in definitions]:
+            log.warning("Not writing a ruleset snapshot, the ruleset would "
+                        "not read back the same from it")
+            return False
+
+        data = dict(version=VERSION, key=key, definitions=definitions,
+                    badge_ids=badge_ids)
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            log.warning("Could not write the ruleset snapshot: %r" % e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
@@ -1,7 +1,13 @@
 """ Utilities for fedbadges that don't quite fit anywhere else. """
 
+import functools
+import threading
 import types
 
+from collections.abc import Mapping
+
+from fedbadges.cache import ExistenceCache, QueryMemo, missing
+
 import logging
 log = logging.getLogger("moksha.hub")
 
@@ -42,6 +48,102 @@ def construct_substitutions(msg):
     return subs
 
 
+_missing = object()
+
+
+class Substitutions(Mapping):
+    """ A lazily computed mapping of substitutions for a fedmsg message.
+
+    It has the same keys and values as ``construct_substitutions(msg)``, but
+    dotted keys like ``msg.comment.update_submitter`` are resolved on demand
+    by walking the message, rather than by flattening the whole thing up
+    front.  Lookups are memoized, so one of these can be built per message
+    and shared by every rule that looks at it.
+
+    The results of the datanommer queries run for the message are kept in
+    ``queries`` for the same reason.
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+        self._cache = {}
+        self._flat = None
+        self._serialized = None
+        self.queries = QueryMemo()
+
+    @property
+    def serialized(self):
+        """ The message as ``json.dumps(msg)``, computed at most once """
+        if self._serialized is None:
+            self._serialized = json.dumps(self.msg)
+        return self._serialized
+
+    def _flatten(self):
+        if self._flat is None:
+            self._flat = construct_substitutions(self.msg)
+        return self._flat
+
+    def _resolve(self, key):
+        obj = self.msg
+        visited = []
+        for part in key.split('.'):
+            if not isinstance(obj, dict) or part not in obj:
+                break
+            visited.append(obj)
+            obj = obj[part]
+        else:
+            if isinstance(obj, str):
+                return obj.lower()
+            return obj
+
+        # The message itself may have keys with dots in them, which can't be
+        # walked.  Only in that case do we need to flatten it the slow way.
+        if isinstance(obj, dict):
+            visited.append(obj)
+        for d in visited:
+            if any([isinstance(k, str) and '.' in k for k in d]):
+                return self._flatten().get(key, _missing)
+        return _missing
+
+    def __getitem__(self, key):
+        value = self._cache.get(key, _missing)
+        if value is _missing and key not in self._cache:
+            value = self._cache[key] = self._resolve(key)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        return iter(self._flatten())
+
+    def __len__(self):
+        return len(self._flatten())
+
+
+def path_accessor(path):
+    """ Compile a dotted path like "msg.comment.user" into an accessor
+
+    The accessor walks dicts by key and lists by index, raising KeyError,
+    IndexError or TypeError if the path isn't there.
+    """
+
+    parts = [
+        (part, int(part) if part.isdigit() else None)
+        for part in str(path).split('.')
+    ]
+
+    def access(obj):
+        for key, index in parts:
+            if isinstance(obj, dict):
+                obj = obj[key]
+            elif index is not None and isinstance(obj, (list, tuple)):
+                obj = obj[index]
+            else:
+                raise KeyError(key)
+        return obj
+    return access
+
+
 def format_args(obj, subs):
     """ Recursively apply a substitutions dict to a given criteria subtree """
 
@@ -60,12 +162,104 @@ def format_args(obj, subs):
     return obj
 
 
+def compile_lambda(expression, name='value'):
+    """ Compile a lambda expression with a single argument into a callable
+
+    Syntax errors are raised as ValueError so they can be reported along with
+    any other problem in a badge definition when it is loaded.
+    """
+
+    try:
+        code = compile("lambda %s: %s" % (name, expression), __file__, "eval")
+    except SyntaxError as e:
+        raise ValueError("Invalid lambda expression %r: %s" % (expression, e))
+    return types.LambdaType(code, globals())()
+
+
+@functools.lru_cache(maxsize=1024)
+def cached_lambda(expression, name='value'):
+    """ Compile a lambda expression, remembering the most recently used ones
+
+    This is for expressions which are only known once a message has been
+    substituted into them.  Lambdas known at load time should be compiled
+    with compile_lambda and kept around by whoever needs them.
+    """
+
+    return compile_lambda(expression, name)
+
+
+def lambda_cache_stats():
+    """ Return the hit/miss counters of the compiled lambda cache """
+
+    return cached_lambda.cache_info()._asdict()
+
+
 def single_argument_lambda_factory(expression, argument, name='value'):
     """ Compile and execute a lambda expression with a single argument """
 
-    code = compile("lambda %s: %s" % (name, expression), __file__, "eval")
-    func = types.LambdaType(code, globals())()
-    return func(argument)
+    return cached_lambda(expression, name)(argument)
+
+
+def _compile_template(obj, lambdas):
+    """ Turn a criteria subtree into a function of (subs, msg) """
+
+    if isinstance(obj, dict):
+        if lambdas and 'lambda' in obj:
+            # The whole dict is replaced by the result of the lambda.
+            expression = obj['lambda']
+            if isinstance(expression, str) and '%' not in expression:
+                function = compile_lambda(expression, name='msg')
+                return lambda subs, msg: function(msg)
+            render = _compile_template(expression, lambdas=False)
+            return lambda subs, msg: cached_lambda(
+                render(subs, msg), name='msg')(msg)
+        items = [
+            (key, _compile_template(value, lambdas))
+            for key, value in obj.items()
+        ]
+        return lambda subs, msg: dict([
+            (key, render(subs, msg)) for key, render in items
+        ])
+    elif isinstance(obj, list):
+        items = [_compile_template(item, lambdas) for item in obj]
+        return lambda subs, msg: [render(subs, msg) for render in items]
+    elif isinstance(obj, str) and obj.startswith('%(') and obj[-2:-1] == ')':
+        # A reference to exactly one substitution, like "%(msg.agent)s".
+        # Hand back the value itself, which may not be a string at all.
+        key = obj[2:-2]
+
+        def render(subs, msg):
+            if key in subs:
+                return subs[key]
+            return obj % subs
+        return render
+    elif isinstance(obj, str) and '%' not in obj:
+        return lambda subs, msg: obj
+    elif isinstance(obj, (int, float)):
+        return lambda subs, msg: obj
+    else:
+        return lambda subs, msg: obj % subs
+
+
+class Template(object):
+    """ A criteria filter or recipient, parsed once and rendered per message.
+
+    Rendering gives the same result as ``format_args`` (followed by
+    ``recursive_lambda_factory`` if ``lambdas`` is True) on a deep copy of
+    the source, but without re-examining the source every time and without
+    ever modifying it.  Lambdas without substitutions in them are compiled
+    here, up front.
+    """
+
+    def __init__(self, obj, lambdas=True):
+        self.source = obj
+        self._render = _compile_template(obj, lambdas)
+
+    def __repr__(self):
+        return "<Template: %r>" % (self.source,)
+
+    def render(self, subs, msg=None):
+        return self._render(subs, msg)
 
 
 def recursive_lambda_factory(obj, arg, name='value'):
@@ -115,25 +309,78 @@ def notification_callback(topic, msg):
     )
 
 
+# Each thread keeps its own keep-alive session to fasjson, and they all
+# share one set of Kerberos credentials.
+_fasjson = threading.local()
+_fasjson_lock = threading.Lock()
+_fasjson_credentials = None
+
+
+def _get_fasjson_credentials(config):
+    global _fasjson_credentials
+    with _fasjson_lock:
+        if _fasjson_credentials is None:
+            os.environ["KRB5_CLIENT_KTNAME"] = config.get("keytab")
+            try:
+                _fasjson_credentials = Credentials(usage="initiate")
+            except exceptions.GSSError as e:
+                log.error("GSSError trying to authenticate to fasjson: %r" % e)
+        return _fasjson_credentials
+
+
 def get_fasjson_session(config):
+    """ Return this thread's session to fasjson. """
+    session = getattr(_fasjson, 'session', None)
+    if session is not None:
+        return session
+
     # fasjson_client not available in python2, so just use requests
-    os.environ["KRB5_CLIENT_KTNAME"] = config.get("keytab")
     session = requests.Session()
-    try:
-        creds = Credentials(usage="initiate")
-    except exceptions.GSSError as e:
-        log.error("GSSError trying to authenticate to fasjson", e)
-    else:
+    creds = _get_fasjson_credentials(config)
+    if creds is not None:
         gssapi_auth = HTTPSPNEGOAuth(opportunistic_auth=True, creds=creds)
         session.auth = gssapi_auth
+        # Only hang on to sessions which can authenticate.  Otherwise, try
+        # again next time.
+        _fasjson.session = session
     return session
 
 
+# Which users exist in FAS.  The consumer sets how long to remember that for.
+fas_cache = ExistenceCache()
+
+
 def user_exists_in_fas(config, user):
     """ Return true if the user exists in FAS. """
+    exists = fas_cache.get(user, missing)
+    if exists is missing:
+        exists = _user_exists_in_fas(config, user)
+        if exists is not None:
+            fas_cache.put(user, exists)
+    return bool(exists)
+
+
+def users_exist_in_fas(config, users):
+    """ Return the set of these users who exist in FAS.
+
+    Whatever the cache doesn't know is asked about one user at a time:
+    fasjson's ``search/users/`` only reads the first ``username__exact`` it
+    is given, and ANDs its terms, so it can't find several users at once.
+    """
+    return set([user for user in set(users)
+                if user_exists_in_fas(config, user)])
+
+
+def _user_exists_in_fas(config, user):
+    """ Ask FAS.  Return None if we can't tell. """
     if config.get("fasjson_base_url", False):
         session = get_fasjson_session(config)
-        return session.get(config['fasjson_base_url']+"users/"+user+"/").ok
+        response = session.get(config['fasjson_base_url']+"users/"+user+"/")
+        if response.ok:
+            return True
+        if response.status_code == 404:
+            return False
+        return None
     else:
         default_url = 'https://admin.fedoraproject.org/accounts/'
         fas2 = fedora.client.AccountSystem(
@@ -6,11 +6,104 @@ config = {
     # may be a relative or an absolute path on the file system.
     "badges.yaml.directory": "tests/test_badges",
 
+    # A file to keep the parsed badge definitions and their Badgr ids in.
+    # When none of the files in the directory above have changed, they're
+    # loaded from there at startup.  Leave this empty to not keep one.
+    "badges.yaml.snapshot": "",
+
     # Number of seconds to delay before consuming a message for our event loop.
     # This is here to help us mitigate distributed race conditions between
     # fedbadges and datanommer.
     "badges.consume_delay": 1,
 
+    # How long to remember that a user exists in FAS, and that one doesn't.
+    # A ttl of 0 turns this off; a negative_ttl of 0 only remembers users
+    # that exist.
+    "badges.fas_cache.ttl": 0,
+    "badges.fas_cache.negative_ttl": 0,
+    "badges.fas_cache.size": 8192,
+
+    # Load every FAS user's IRC nicks, emails and GitHub username from
+    # fasjson at startup, refresh them every so often, and look there first
+    # for rules with recipient_nick2fas, _email2fas or _github2fas.  Aliases
+    # that aren't in there are looked up as before (with "workers" threads)
+    # and remembered for ttl seconds, or negative_ttl if nobody was found.
+    # A ttl of 0 turns this off.
+    "badges.aliases.ttl": 0,
+    "badges.aliases.negative_ttl": 600,
+    "badges.aliases.refresh": 3600,
+    "badges.aliases.workers": 8,
+
+    # Every thread talking to Badgr keeps a connection open, but no more
+    # than pool_size requests are made at once.  Each may take up to timeout
+    # seconds.
+    "badges.badgr.pool_size": 10,
+    "badges.badgr.timeout": 30,
+
+    # At startup, badges that aren't in Badgr yet are created this many at a
+    # time.
+    "badges.badgr.sync_workers": 8,
+
+    # Load every assertion of our issuer from Badgr at startup, and again
+    # every "refresh" seconds, to tell who already has a badge without asking
+    # Badgr for each of them.  Badges we award are added as we go.  0 turns
+    # this off.
+    "badges.assertions.refresh": 0,
+
+    # Award badges from this many threads, so that evaluating rules never
+    # waits on Badgr.  Each takes up to "batch" awards at a time, and retries
+    # failed ones "retries" times, waiting "backoff" seconds, then twice
+    # that, and so on.  0 awards each badge as soon as it's earned.
+    "badges.awards.workers": 0,
+    "badges.awards.batch": 20,
+    "badges.awards.retries": 3,
+    "badges.awards.backoff": 1,
+
+    # A SQLite file to write every award to before it is made.  Awards that
+    # were never made (Badgr was down, or we were stopped) are made at the
+    # next start.  Leave this empty to not keep one.
+    "badges.awards.outbox": "",
+
+    # Time each stage of each rule (trigger, recipients, assertion, criteria,
+    # datanommer, fas, award) and count how it turned out.  If a port is
+    # given, they're served there in the Prometheus text format.
+    "badges.metrics.enabled": False,
+    "badges.metrics.port": 0,
+    "badges.metrics.address": "",
+
+    # How many of the rules triggered by a message have their criteria
+    # checked at the same time, in a pool of threads.  1 checks them one by
+    # one.  Either way, badges are awarded in the order the rules are loaded.
+    "badges.concurrency": 1,
+
+    # The most datanommer queries to have running at once (0 for no limit).
+    # Each query's connection goes back to the pool as soon as it is done.
+    "badges.datanommer_connections": 0,
+
+    # The parts of an "any" or "all" criteria are checked cheapest and most
+    # likely to settle the answer first, as measured while running.  Turn
+    # this on to check them in the order they're written in instead.
+    "badges.criteria.pin_order": False,
+
+    # With this on, "count" criteria with a numeric condition stop counting
+    # as soon as the answer is known ("greater than or equal to: 1" only
+    # needs to find one message), rather than counting every match.
+    "badges.bounded_counts": False,
+
+    # Keep per-user message counts, by topic and category, in memory.  They
+    # are seeded from datanommer at startup for the categories the rules
+    # count (plus any listed here), and answer "count" criteria filtering on
+    # one user and some topics or categories without asking datanommer.
+    "badges.counters.enabled": False,
+    "badges.counters.categories": [],
+
+    # Results of datanommer criteria can be cached for this many seconds, for
+    # up to this many distinct queries.  A cached result is thrown away as
+    # soon as a message comes in from one of the users (or on one of the
+    # topics) it was about.  A ttl of 0 turns the cache off.
+    "badges.criteria_cache.ttl": 0,
+    "badges.criteria_cache.size": 4096,
+
     # This is a dictionary of tahrir-related configuration
     "badges_global": {
 
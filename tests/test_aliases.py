@@ -0,0 +1,98 @@
+import unittest
+import mock
+from nose.tools import eq_
+
+from fedbadges.aliases import AliasMap, alias_key, load_from_fasjson
+
+# Utils for tests
+from .utils import FakeClock
+
+
+class TestAliasMap(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.aliases = AliasMap(ttl=100, negative_ttl=10, workers=4,
+                                clock=self.clock)
+        self.aliases.load([
+            ('nick', 'Threebean', 'ralph'),
+            ('email', 'rbean@redhat.com', 'ralph'),
+            ('github', 'ralphbean', 'ralph'),
+        ])
+        self.looked_up = []
+
+    def lookup(self, value, **config):
+        self.looked_up.append(value)
+        return {'abompard': 'abompard'}.get(value)
+
+    def test_key(self):
+        eq_(alias_key('nick', 'Threebean'), ('nick', 'threebean'))
+        eq_(alias_key('github', 'https://api.github.com/users/ralphbean'),
+            ('github', 'ralphbean'))
+        eq_(alias_key('github', 'https://github.com/ralphbean'), None)
+
+    def test_disabled(self):
+        aliases = AliasMap()
+        eq_(aliases.resolve('nick', ['abompard'], self.lookup, {}),
+            ['abompard'])
+        eq_(self.looked_up, ['abompard'])
+
+    def test_hits_skip_lookup(self):
+        eq_(self.aliases.resolve('nick', ['threebean'], self.lookup, {}),
+            ['ralph'])
+        eq_(self.aliases.resolve('github', [
+            'https://api.github.com/users/ralphbean'], self.lookup, {}),
+            ['ralph'])
+        eq_(self.looked_up, [])
+
+    def test_misses_are_batched_and_remembered(self):
+        eq_(self.aliases.resolve('nick', ['abompard', 'threebean', 'nobody'],
+                                 self.lookup, {}),
+            ['abompard', 'ralph', None])
+        eq_(sorted(self.looked_up), ['abompard', 'nobody'])
+        self.aliases.resolve('nick', ['abompard', 'nobody'], self.lookup, {})
+        eq_(len(self.looked_up), 2)
+
+        # Nobody is forgotten sooner than somebody.
+        self.clock.now += 50
+        self.aliases.resolve('nick', ['abompard', 'nobody'], self.lookup, {})
+        eq_(self.looked_up[2:], ['nobody'])
+
+    def test_per_entry_ttl(self):
+        self.clock.now += 100
+        eq_(self.aliases.get('nick', 'threebean'), None)
+
+    def test_refresh_keeps_lookups(self):
+        self.aliases.resolve('nick', ['abompard'], self.lookup, {})
+        self.aliases.load([('nick', 'toshio', 'toshio')])
+        eq_(self.aliases.get('nick', 'abompard'), 'abompard')
+        eq_(self.aliases.get('nick', 'toshio'), 'toshio')
+        eq_(self.aliases.get('nick', 'threebean'), None)
+
+
+class TestLoadFromFasjson(unittest.TestCase):
+    def test_pages(self):
+        pages = [
+            dict(result=[dict(username='ralph',
+                              emails=['rbean@redhat.com'],
+                              ircnicks=['irc:/threebean',
+                                        'matrix://example.com/ralph'],
+                              github_username='ralphbean')],
+                 page=dict(total_pages=2)),
+            dict(result=[dict(username='toshio', emails=None,
+                              ircnicks=['irc://irc.libera.chat/abadger1999'],
+                              github_username=None)],
+                 page=dict(total_pages=2)),
+        ]
+        session = mock.Mock()
+        session.get.side_effect = [
+            mock.Mock(json=mock.Mock(return_value=page)) for page in pages]
+        config = {"fasjson_base_url": "https://fasjson.example.com/v1/"}
+        with mock.patch('fedbadges.aliases.get_fasjson_session',
+                        return_value=session):
+            eq_(list(load_from_fasjson(config)), [
+                ('email', 'rbean@redhat.com', 'ralph'),
+                ('nick', 'threebean', 'ralph'),
+                ('github', 'ralphbean', 'ralph'),
+                ('nick', 'abadger1999', 'toshio'),
+            ])
+        eq_(session.get.call_args_list[1][1]['params']['page_number'], 2)
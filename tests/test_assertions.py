@@ -0,0 +1,288 @@
+import sys
+import threading
+import unittest
+import mock
+from nose.tools import eq_
+
+import fedbadges.consumers
+import fedbadges.rules
+from fedbadges.assertions import (
+    AssertionIndex,
+    IdSet,
+    load_from_badgr,
+    recipient_identity,
+)
+
+
+class TestAssertionIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = AssertionIndex()
+
+    def test_not_loaded(self):
+        eq_(self.index.enabled, False)
+
+    def test_load(self):
+        self.index.load(lambda: [('badge1', 'Ralph@fedoraproject.org'),
+                                 ('badge2', 'toshio@fedoraproject.org')])
+        eq_(self.index.enabled, True)
+        eq_(self.index.has('badge1', 'ralph@fedoraproject.org'), True)
+        eq_(self.index.has('badge1', 'toshio@fedoraproject.org'), False)
+        eq_(self.index.has('badge3', 'ralph@fedoraproject.org'), False)
+        eq_(len(self.index), 2)
+
+    def test_add(self):
+        self.index.load(lambda: [])
+        self.index.add('badge1', 'ralph@fedoraproject.org')
+        eq_(self.index.has('badge1', 'ralph@fedoraproject.org'), True)
+
+    def test_reload_replaces(self):
+        self.index.load(lambda: [('badge1', 'ralph@fedoraproject.org')])
+        self.index.load(lambda: [('badge2', 'ralph@fedoraproject.org')])
+        eq_(self.index.has('badge1', 'ralph@fedoraproject.org'), False)
+        eq_(self.index.has('badge2', 'ralph@fedoraproject.org'), True)
+
+    def test_added_during_reload_is_kept(self):
+        """ Test that a badge awarded while reloading isn't forgotten """
+        def loader():
+            self.index.add('badge1', 'toshio@fedoraproject.org')
+            yield 'badge1', 'ralph@fedoraproject.org'
+
+        self.index.load(loader)
+        eq_(self.index.has('badge1', 'ralph@fedoraproject.org'), True)
+        eq_(self.index.has('badge1', 'toshio@fedoraproject.org'), True)
+
+    def test_failed_reload_keeps_old(self):
+        self.index.load(lambda: [('badge1', 'ralph@fedoraproject.org')])
+
+        def loader():
+            raise IOError("badgr is down")
+
+        try:
+            self.index.load(loader)
+        except IOError:
+            pass
+        eq_(self.index.has('badge1', 'ralph@fedoraproject.org'), True)
+
+    def test_start(self):
+        loaded = threading.Event()
+
+        def loader():
+            loaded.set()
+            return [('badge1', 'ralph@fedoraproject.org')]
+
+        self.index.start(loader, refresh=60)
+        self.index.stop()
+        assert loaded.is_set()
+        eq_(self.index.has('badge1', 'ralph@fedoraproject.org'), True)
+
+    def test_reload_while_reading(self):
+        """ Test that ids from one load are never paired with another's """
+        orders = [
+            [('OTHER', 'alice@fedoraproject.org'),
+             ('BADGE', 'bob@fedoraproject.org')],
+            [('BADGE', 'bob@fedoraproject.org'),
+             ('OTHER', 'alice@fedoraproject.org')],
+        ]
+        self.index.load(lambda: orders[0])
+        done = threading.Event()
+
+        def reload():
+            for i in range(2000):
+                self.index.load(lambda: orders[i % 2])
+            done.set()
+
+        thread = threading.Thread(target=reload)
+        thread.start()
+        while not done.is_set():
+            eq_(self.index.has('BADGE', 'alice@fedoraproject.org'), False)
+        thread.join()
+
+
+class TestIdSet(unittest.TestCase):
+    def check(self, ids, members):
+        for i in range(max(members) + 20):
+            eq_(i in ids, i in members)
+        eq_(len(ids), len(members))
+
+    def test_sparse(self):
+        ids = IdSet([100000, 5, 70000])
+        ids.add(300)
+        ids.add(5)
+        assert not isinstance(ids._store, bytearray)
+        self.check(ids, {5, 300, 70000, 100000})
+
+    def test_dense(self):
+        members = set(range(0, 1000, 3))
+        ids = IdSet(members)
+        assert isinstance(ids._store, bytearray)
+        self.check(ids, members)
+
+    def test_read_while_becoming_dense(self):
+        ids = IdSet()
+        done = threading.Event()
+
+        def fill():
+            for i in range(0, 4000, 3):
+                ids.add(i)
+            done.set()
+
+        thread = threading.Thread(target=fill)
+        thread.start()
+        while not done.is_set():
+            eq_(1 in ids, False)
+        thread.join()
+        assert isinstance(ids._store, bytearray)
+
+    def test_becomes_dense(self):
+        ids = IdSet([640])
+        members = {640}
+        for i in range(0, 640, 7):
+            ids.add(i)
+            members.add(i)
+        assert isinstance(ids._store, bytearray)
+        ids.add(2000)
+        members.add(2000)
+        self.check(ids, members)
+
+
+class TestIndexFootprint(unittest.TestCase):
+    def test_smaller_than_tuples(self):
+        """ Test that the index is smaller than a set of tuples """
+        # 100 badges, the first few held by most of 5000 people, the rest by
+        # fewer and fewer of them.
+        pairs = [
+            ('badge%i' % badge, 'user%i@fedoraproject.org' % user)
+            for badge in range(100)
+            for user in range(0, 5000, badge + 1)
+        ]
+        index = AssertionIndex()
+        index.load(lambda: pairs)
+        eq_(len(index), len(pairs))
+
+        naive = set(pairs)
+        naive_bytes = sys.getsizeof(naive) + sum([
+            sys.getsizeof(pair) + sys.getsizeof(pair[1]) for pair in naive])
+        assert index.nbytes() * 10 < naive_bytes, \
+            (index.nbytes(), naive_bytes)
+
+    def test_unknown_is_a_definite_negative(self):
+        index = AssertionIndex()
+        index.load(lambda: [('badge1', 'ralph@fedoraproject.org')])
+        eq_(index.has('badge1', 'nobody@fedoraproject.org'), False)
+        eq_(index.has('badge2', 'ralph@fedoraproject.org'), False)
+        stats = index.stats()
+        eq_((stats['negatives'], stats['misses']), (1, 1))
+
+
+class TestLoadFromBadgr(unittest.TestCase):
+    def test_recipient_identity(self):
+        eq_(recipient_identity({'recipient': {
+            'type': 'email', 'hashed': False,
+            'identity': 'Ralph@fedoraproject.org'}}),
+            'ralph@fedoraproject.org')
+        eq_(recipient_identity({'recipient': {
+            'type': 'email', 'hashed': True, 'identity': 'sha256$abcd',
+            'plaintextIdentity': 'ralph@fedoraproject.org'}}),
+            'ralph@fedoraproject.org')
+        eq_(recipient_identity({'recipient': {
+            'type': 'email', 'hashed': True, 'identity': 'sha256$abcd'}}),
+            None)
+        eq_(recipient_identity({'recipient': {
+            'type': 'url', 'identity': 'http://example.com'}}), None)
+
+    @mock.patch('badgrclient.Issuer.fetch_assertions')
+    def test_load(self, fetch_assertions):
+        def assertion(data):
+            return mock.Mock(data=data)
+
+        fetch_assertions.return_value = [
+            assertion({'badgeclass': 'badge1', 'recipient': {
+                'type': 'email', 'identity': 'ralph@fedoraproject.org'}}),
+            assertion({'badgeclass': 'badge1', 'revoked': True, 'recipient': {
+                'type': 'email', 'identity': 'toshio@fedoraproject.org'}}),
+            assertion({'badgeclass': 'badge2', 'recipient': {
+                'type': 'email', 'hashed': True, 'identity': 'sha256$a'}}),
+        ]
+        eq_(list(load_from_badgr(mock.Mock(), 'issuer')),
+            [('badge1', 'ralph@fedoraproject.org')])
+
+
+class TestRuleUsesIndex(unittest.TestCase):
+    def setUp(self):
+        class MockBadgrClient(object):
+            unique_badge_names = True
+
+            def get_eid_from_badge_name(self, badge_name, issuer_id):
+                return 'randomid'
+
+        self.rule = fedbadges.rules.BadgeRule(dict(
+            name="Test",
+            description="Doesn't matter...",
+            creator="Somebody",
+            discussion="http://somelink.com",
+            issuer_id="fedora-project",
+            image_url="http://somelinke.com/something.png",
+            trigger=dict(category="fas"),
+            criteria=dict(datanommer=dict(
+                filter=dict(categories=["pkgdb"]),
+                operation="count",
+                condition={"greater than or equal to": 1}
+            ))
+        ), MockBadgrClient(), None)
+        fedbadges.rules.assertion_index.load(
+            lambda: [('randomid', 'toshio@fedoraproject.org')])
+
+    def tearDown(self):
+        fedbadges.rules.assertion_index.clear()
+
+    @mock.patch('badgrclient.BadgeClass.fetch_assertions')
+    def test_against_duplicates(self, fetch_assertions):
+        msg = {
+            'topic': 'org.fedoraproject.stg.fas.role.update',
+            'msg': {
+                'group': {'name': 'ambassadors'},
+                'user': {'username': 'ralph'},
+                'agent': {'username': 'toshio'},
+            }
+        }
+        with mock.patch('fedmsg.meta.msg2usernames',
+                        return_value=set(['ralph', 'toshio'])), \
+                mock.patch.object(self.rule.criteria, 'matches',
+                                  return_value=True), \
+                mock.patch("fedbadges.rules.users_exist_in_fas") as g:
+            g.side_effect = lambda config, users: set(users)
+            eq_(self.rule.matches(msg), set(['ralph']))
+        eq_(fetch_assertions.call_count, 0)
+
+
+class TestAwardChecksBadgr(unittest.TestCase):
+    def setUp(self):
+        self.rule = mock.MagicMock(badge_id='badge1')
+
+    def tearDown(self):
+        fedbadges.rules.assertion_index.clear()
+
+    def award(self, exists):
+        with mock.patch('fedbadges.consumers.assertion_exists',
+                        return_value=exists), \
+                mock.patch('badgrclient.BadgeClass.issue') as issue:
+            fedbadges.consumers.FedoraBadgesConsumer.award_badge(
+                None, 'ralph', self.rule)
+        return issue.call_count
+
+    def test_index_is_not_trusted(self):
+        fedbadges.rules.assertion_index.load(
+            lambda: [('badge1', 'ralph@fedoraproject.org')])
+        eq_(self.award(exists=False), 1)
+
+    def test_index_is_updated(self):
+        index = fedbadges.rules.assertion_index
+        index.load(lambda: [])
+        eq_(self.award(exists=False), 1)
+        eq_(index.has('badge1', 'ralph@fedoraproject.org'), True)
+        eq_(self.award(exists=True), 0)
+
+    def test_index_is_left_alone_when_disabled(self):
+        eq_(self.award(exists=False), 1)
+        eq_(fedbadges.rules.assertion_index.enabled, False)
+        eq_(len(fedbadges.rules.assertion_index), 0)
@@ -0,0 +1,101 @@
+import threading
+import unittest
+from nose.tools import eq_
+
+from fedbadges.awards import AwardWriter
+
+# Utils for tests
+from .utils import MockRule
+
+
+class TestAwardWriter(unittest.TestCase):
+    def setUp(self):
+        self.awarded = []
+        self.lock = threading.Lock()
+        self.rule = MockRule('badge1')
+
+    def award(self, username, badge_rule, link):
+        with self.lock:
+            self.awarded.append((badge_rule.badge_id, username))
+
+    def test_inline(self):
+        writer = AwardWriter(self.award)
+        writer.start()
+        eq_(writer.submit('ralph', self.rule), True)
+        eq_(self.awarded, [('badge1', 'ralph')])
+
+    def test_inline_errors_are_raised(self):
+        def award(username, badge_rule, link):
+            raise IOError("badgr is down")
+
+        writer = AwardWriter(award)
+        self.assertRaises(IOError, writer.submit, 'ralph', self.rule)
+        eq_(writer.stats()['pending'], 0)
+
+    def test_background(self):
+        writer = AwardWriter(self.award, workers=2, batch=3)
+        writer.start()
+        for username in ['ralph', 'toshio', 'lmacken', 'decause']:
+            writer.submit(username, self.rule)
+        writer.submit('ralph', MockRule('badge2'))
+        writer.stop()
+        eq_(sorted(self.awarded), [
+            ('badge1', 'decause'),
+            ('badge1', 'lmacken'),
+            ('badge1', 'ralph'),
+            ('badge1', 'toshio'),
+            ('badge2', 'ralph'),
+        ])
+
+    def test_duplicates_are_dropped(self):
+        """ Test that an award already on its way isn't queued again """
+        writing = threading.Event()
+        release = threading.Event()
+
+        def award(username, badge_rule, link):
+            writing.set()
+            release.wait(5)
+            self.award(username, badge_rule, link)
+
+        writer = AwardWriter(award, workers=1)
+        writer.start()
+        eq_(writer.submit('ralph', self.rule), True)
+        writing.wait(5)
+        eq_(writer.submit('ralph', self.rule), False)
+        release.set()
+        writer.join()
+        eq_(self.awarded, [('badge1', 'ralph')])
+
+        # Once it's written, it may be submitted again.
+        eq_(writer.submit('ralph', self.rule), True)
+        writer.stop()
+        eq_(writer.stats()['duplicates'], 1)
+
+    def test_retries_with_backoff(self):
+        failures = [IOError("one"), IOError("two")]
+        slept = []
+
+        def award(username, badge_rule, link):
+            if failures:
+                raise failures.pop(0)
+            self.award(username, badge_rule, link)
+
+        writer = AwardWriter(award, workers=1, retries=3, backoff=0.5,
+                             sleep=slept.append)
+        writer.start()
+        writer.submit('ralph', self.rule)
+        writer.stop()
+        eq_(self.awarded, [('badge1', 'ralph')])
+        eq_(slept, [0.5, 1.0])
+
+    def test_gives_up(self):
+        def award(username, badge_rule, link):
+            raise IOError("badgr is down")
+
+        writer = AwardWriter(award, workers=1, retries=2,
+                             sleep=lambda delay: None)
+        writer.start()
+        writer.submit('ralph', self.rule)
+        writer.stop()
+        stats = writer.stats()
+        eq_((stats['failures'], stats['pending']), (1, 0))
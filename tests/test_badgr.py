@@ -0,0 +1,108 @@
+import datetime
+import threading
+import time
+import unittest
+from mock import patch, Mock
+from nose.tools import eq_
+
+import fedbadges.metrics
+from fedbadges.badgr import PooledBadgrClient
+
+
+class TestPooledBadgrClient(unittest.TestCase):
+    def setUp(self):
+        self.tokens = []
+
+        def get_token(client, *args, **kwargs):
+            self.tokens.append(threading.current_thread().name)
+            time.sleep(0.01)
+            client.token_expires_at = datetime.datetime.now() + \
+                datetime.timedelta(hours=1)
+            client.header = {"Authorization": "Bearer %i" % len(self.tokens)}
+
+        patcher = patch('badgrclient.BadgrClient._get_auth_token',
+                        autospec=True, side_effect=get_token)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = PooledBadgrClient(
+            username="test_user", password="password", client_id="public",
+            pool_size=2, timeout=5)
+
+    def respond(self, delay=0):
+        response = Mock(status_code=200)
+        response.json.return_value = {"status": {"success": True},
+                                      "result": []}
+
+        def request(session, method, url, **kwargs):
+            time.sleep(delay)
+            return response
+
+        return patch('requests.Session.request', autospec=True,
+                     side_effect=request)
+
+    def test_session_per_thread(self):
+        sessions = []
+
+        def run():
+            sessions.append(self.client.session)
+            sessions.append(self.client.session)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        assert sessions[0] is sessions[1]
+        assert sessions[0] is not self.client.session
+
+    def test_timeout(self):
+        with self.respond() as request:
+            self.client.fetch_issuer()
+        eq_(request.call_args[1]['timeout'], 5)
+
+    def test_token_refreshed_once(self):
+        """ Test that an expired token is refreshed once for everybody """
+        self.client.token_expires_at = datetime.datetime.now() - \
+            datetime.timedelta(seconds=1)
+        threads = [threading.Thread(target=self.client.fetch_issuer)
+                   for i in range(4)]
+        with self.respond():
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        eq_(len(self.tokens), 2)
+        eq_(self.client.header, {"Authorization": "Bearer 2"})
+
+    def test_pool_size(self):
+        running = [0, 0]
+        lock = threading.Lock()
+
+        def request(session, method, url, **kwargs):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return Mock(status_code=200, json=lambda: {"result": []})
+
+        threads = [threading.Thread(target=self.client.fetch_issuer)
+                   for i in range(6)]
+        with patch('requests.Session.request', autospec=True,
+                   side_effect=request):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        eq_(running[1], 2)
+
+    def test_latency_is_recorded(self):
+        fedbadges.metrics.enabled = True
+        try:
+            before = fedbadges.metrics.request_seconds.count(
+                ('badgr', 'GET', 'hit'))
+            with self.respond():
+                self.client.fetch_issuer()
+            eq_(fedbadges.metrics.request_seconds.count(
+                ('badgr', 'GET', 'hit')), before + 1)
+        finally:
+            fedbadges.metrics.enabled = False
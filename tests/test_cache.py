@@ -0,0 +1,207 @@
+import unittest
+import mock
+from nose.tools import eq_
+
+import fedbadges.rules
+from fedbadges.cache import TTLCache, CriteriaCache, QueryMemo, missing
+from fedbadges.utils import Substitutions
+
+# Utils for tests
+from .utils import FakeClock
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TTLCache(ttl=10, maxsize=2, clock=self.clock)
+
+    def test_disabled(self):
+        cache = TTLCache()
+        cache.set('a', 1)
+        eq_(cache.get('a'), None)
+        eq_(len(cache), 0)
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+        self.clock.now += 9
+        eq_(self.cache.get('a'), 1)
+        self.clock.now += 1
+        eq_(self.cache.get('a'), None)
+        eq_(self.cache.stats()['expirations'], 1)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        eq_(self.cache.get('b'), None)
+        eq_(self.cache.get('a'), 1)
+        eq_(self.cache.get('c'), 3)
+        stats = self.cache.stats()
+        eq_(stats['evictions'], 1)
+        eq_(stats['hits'], 3)
+        eq_(stats['misses'], 1)
+
+
+class TestQueryMemo(unittest.TestCase):
+    def test_computed_once(self):
+        memo = QueryMemo()
+        calls = []
+        compute = lambda: calls.append(1) or len(calls)
+        eq_(memo.get('a', compute), 1)
+        eq_(memo.get('a', compute), 1)
+        eq_(memo.get('b', compute), 2)
+        eq_((memo.hits, memo.misses), (1, 2))
+
+    def test_exception_is_shared(self):
+        memo = QueryMemo()
+
+        def compute():
+            raise ValueError("nope")
+
+        for i in range(2):
+            try:
+                memo.get('a', compute)
+            except ValueError:
+                pass
+            else:
+                assert False, "ValueError not raised"
+        eq_(memo.misses, 1)
+
+
+class TestCriteriaCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = CriteriaCache(ttl=60, maxsize=10, clock=self.clock)
+
+    def put(self, kwargs, value):
+        since = self.cache.now()
+        self.clock.now += 1
+        self.cache.put(kwargs, 'count', value, since)
+
+    def test_key_is_canonical(self):
+        eq_(CriteriaCache.key(dict(users=['ralph'], topics=['a']), 'count'),
+            CriteriaCache.key(dict(topics=['a'], users=['ralph']), 'count'))
+
+    def test_invalidated_by_user(self):
+        self.put(dict(users=['ralph'], topics=['a.b']), 5)
+        self.cache.message_arrived(['toshio'], 'a.b')
+        eq_(self.cache.lookup(dict(users=['ralph'], topics=['a.b']), 'count'),
+            5)
+        self.cache.message_arrived(['Ralph'], 'c.d')
+        eq_(self.cache.lookup(dict(users=['ralph'], topics=['a.b']), 'count'),
+            missing)
+        eq_(self.cache.stats()['invalidations'], 1)
+
+    def test_invalidated_by_topic(self):
+        self.put(dict(topics=['a.b']), 5)
+        self.cache.message_arrived(['ralph'], 'a.b')
+        eq_(self.cache.lookup(dict(topics=['a.b']), 'count'), missing)
+
+    def test_invalidated_by_category(self):
+        kwargs = dict(categories=['bodhi'])
+        self.put(kwargs, 5)
+        self.cache.message_arrived([], 'org.fedoraproject.prod.git.receive')
+        eq_(self.cache.lookup(kwargs, 'count'), 5)
+        self.cache.message_arrived([], 'org.fedoraproject.prod.bodhi.update')
+        eq_(self.cache.lookup(kwargs, 'count'), missing)
+
+    def test_unfiltered_invalidated_by_anything(self):
+        self.put(dict(not_users=['ralph']), 5)
+        self.cache.message_arrived([], 'a.b')
+        eq_(self.cache.lookup(dict(not_users=['ralph']), 'count'), missing)
+
+    def test_message_during_query(self):
+        """ Test that a message which arrives mid-query still invalidates """
+        kwargs = dict(users=['ralph'])
+        since = self.cache.now()
+        self.clock.now += 1
+        self.cache.message_arrived(['ralph'], 'a.b')
+        self.clock.now += 1
+        self.cache.put(kwargs, 'count', 5, since)
+        eq_(self.cache.lookup(kwargs, 'count'), missing)
+
+    def test_ttl_counts_from_query_start(self):
+        kwargs = dict(users=['ralph'])
+        since = self.cache.now()
+        self.clock.now += 30
+        self.cache.put(kwargs, 'count', 5, since)
+        self.clock.now += 29
+        eq_(self.cache.lookup(kwargs, 'count'), 5)
+        self.clock.now += 1
+        eq_(self.cache.lookup(kwargs, 'count'), missing)
+
+
+class TestCachedCriteria(unittest.TestCase):
+    def setUp(self):
+        fedbadges.rules.criteria_cache.configure(ttl=60, maxsize=10)
+        self.criteria = fedbadges.rules.Criteria(dict(
+            datanommer={
+                "filter": {
+                    "users": ["%(msg.agent)s"],
+                },
+                "operation": "count",
+                "condition": {
+                    "greater than or equal to": 2,
+                }
+            }
+        ))
+        self.message = dict(
+            topic="org.fedoraproject.dev.something.sometopic",
+            msg=dict(agent="ralph"),
+        )
+
+    def tearDown(self):
+        fedbadges.rules.criteria_cache.configure(ttl=0, maxsize=0)
+
+    def test_second_lookup_is_cached(self):
+        with mock.patch('datanommer.models.Message.grep') as f:
+            f.return_value = 5, None, None
+            eq_(self.criteria.matches(self.message), True)
+            eq_(self.criteria.matches(self.message), True)
+            eq_(f.call_count, 1)
+
+    def test_new_message_invalidates(self):
+        with mock.patch('datanommer.models.Message.grep') as f:
+            f.return_value = 1, None, None
+            eq_(self.criteria.matches(self.message), False)
+            fedbadges.rules.criteria_cache.message_arrived(
+                ['ralph'], self.message['topic'])
+            f.return_value = 2, None, None
+            eq_(self.criteria.matches(self.message), True)
+            eq_(f.call_count, 2)
+
+
+class TestCoalescedCriteria(unittest.TestCase):
+    def make_criteria(self, threshold):
+        return fedbadges.rules.Criteria(dict(
+            datanommer={
+                "filter": {
+                    "topics": ["%(topic)s"],
+                    "users": ["%(msg.agent)s"],
+                },
+                "operation": "count",
+                "condition": {
+                    "greater than or equal to": threshold,
+                }
+            }
+        ))
+
+    def test_one_query_per_message(self):
+        """ Test that a badge series only asks datanommer once """
+        series = [self.make_criteria(n) for n in (1, 5, 10, 50)]
+        message = dict(
+            topic="org.fedoraproject.prod.pagure.pull-request.new",
+            msg=dict(agent="ralph"),
+        )
+        with mock.patch('datanommer.models.Message.grep') as f:
+            f.return_value = 7, None, None
+            subs = Substitutions(message)
+            results = [c.matches(message, subs) for c in series]
+            eq_(results, [True, True, False, False])
+            eq_(f.call_count, 1)
+
+            # A new message is asked about afresh.
+            subs = Substitutions(message)
+            series[0].matches(message, subs)
+            eq_(f.call_count, 2)
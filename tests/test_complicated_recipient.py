@@ -2,6 +2,7 @@ import unittest
 import logging
 
 import fedbadges.consumers
+import fedbadges.rules
 
 from mock import patch, Mock
 from nose.tools import eq_
@@ -58,8 +59,8 @@ class TestComplicatedRecipient(unittest.TestCase):
         grep.return_value = float("inf"), 1, MockQuery()
         fetch_assertions.return_value = []
 
-        with patch("fedbadges.rules.user_exists_in_fas") as g:
-            g.return_value = True
+        with patch("fedbadges.rules.users_exist_in_fas") as g:
+            g.side_effect = lambda config, users: set(users)
             eq_(self.rule.matches(msg), set(['zodbot', 'threebean']))
 
 
@@ -103,8 +104,8 @@ class TestComplicatedRecipient(unittest.TestCase):
         grep.return_value = float("inf"), 1, MockQuery()
         fetch_assertions.return_value = []
 
-        with patch("fedbadges.rules.user_exists_in_fas") as g:
-            g.return_value = True
+        with patch("fedbadges.rules.users_exist_in_fas") as g:
+            g.side_effect = lambda config, users: set(users)
             eq_(self.rule.matches(msg), set(['pingou', 'lsedlar']))
 
     @patch('datanommer.models.Message.grep')
@@ -145,6 +146,54 @@ class TestComplicatedRecipient(unittest.TestCase):
         grep.return_value = float("inf"), 1, MockQuery()
         fetch_assertions.return_value = []
 
-        with patch("fedbadges.rules.user_exists_in_fas") as g:
-            g.return_value = True
+        with patch("fedbadges.rules.users_exist_in_fas") as g:
+            g.side_effect = lambda config, users: set(users)
             self.assertRaises(Exception, "Multiple recipients : name not found in the message")
+
+
+class TestRecipientPipeline(unittest.TestCase):
+    def test_no_steps(self):
+        pipeline = fedbadges.rules.RecipientPipeline(banned=['bodhi'])
+        eq_(pipeline(['ralph', 'bodhi', '10.0.0.1', '192.168.1.1', None]),
+            frozenset(['ralph']))
+
+    def test_local_steps_in_one_pass(self):
+        pipeline = fedbadges.rules.RecipientPipeline(
+            ['krb2fas', 'openid2fas', 'distgit2fas'])
+        eq_(len(pipeline.stages), 1)
+        eq_(pipeline([
+            'http://ralph.id.fedoraproject.org',
+            'https://src.fedoraproject.org/user/toshio',
+            'packagerbot/os-master02.iad2.fedoraproject.org',
+        ]), frozenset(['ralph', 'toshio', 'packagerbot']))
+
+    def test_from_rule(self):
+        pipeline = fedbadges.rules.RecipientPipeline.from_rule(dict(
+            recipient="%(msg.user)s",
+            recipient_krb2fas=True,
+            recipient_openid2fas=True,
+            recipient_email2fas=False,
+        ))
+        eq_(pipeline.steps, ['openid2fas', 'krb2fas'])
+
+        # Without a recipient, the flags don't apply.
+        pipeline = fedbadges.rules.RecipientPipeline.from_rule(dict(
+            recipient_krb2fas=True,
+        ))
+        eq_(pipeline.steps, [])
+
+    def test_none_stops_the_chain(self):
+        pipeline = fedbadges.rules.RecipientPipeline(
+            ['github2fas', 'distgit2fas'])
+        with patch('fedbadges.rules.github2fas', return_value=None) as g:
+            eq_(pipeline(['https://api.github.com/users/nobody']),
+                frozenset())
+            eq_(g.call_count, 1)
+
+    def test_unknown_step(self):
+        try:
+            fedbadges.rules.RecipientPipeline(['wat2fas'])
+        except KeyError:
+            pass
+        else:
+            assert False, "KeyError not raised"
@@ -108,6 +108,6 @@ class TestComplicatedTrigger(unittest.TestCase):
         grep.return_value = float("inf"), 1, MockQuery()
         fetch_assertions.return_value = []
 
-        with patch("fedbadges.rules.user_exists_in_fas") as g:
-            g.return_value = True
+        with patch("fedbadges.rules.users_exist_in_fas") as g:
+            g.side_effect = lambda config, users: set(users)
             eq_(self.rule.matches(msg), set(['ralph']))
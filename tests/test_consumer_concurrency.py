@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+import unittest
+
+import fedbadges.consumers
+import fedbadges.dispatch
+
+from mock import patch
+from nose.tools import eq_
+
+# Utils for tests
+from .utils import MockHub
+
+
+class MockRule(object):
+    def __init__(self, name, awardees, error=None):
+        self.name = name
+        self.badge_id = name
+        self.awardees = awardees
+        self.error = error
+        self.triggers = 0
+
+    def trigger_matches(self, msg, subs=None):
+        self.triggers += 1
+        return self.awardees is not None
+
+    def matches(self, msg, subs=None, triggered=False):
+        time.sleep(random.random() / 100)
+        if self.error:
+            raise self.error
+        if not triggered and not self.trigger_matches(msg, subs):
+            return set()
+        return set(self.awardees)
+
+
+class TestConcurrentEvaluation(unittest.TestCase):
+
+    @patch('fedmsg.init')
+    @patch('badgrclient.BadgrClient._get_auth_token')
+    @patch('badgrclient.BadgrClient._call_api')
+    @patch('badgrclient.Issuer.create')
+    @patch('badgrclient.BadgeClass.create')
+    def setUp(self, create_badge, create_issuer, _call_api, _get_auth_token, fedmsg_init):
+        hub = MockHub()
+        hub.config = dict(hub.config, **{"badges.concurrency": 3})
+        self.consumer = fedbadges.consumers.FedoraBadgesConsumer(hub)
+        self.rules = [
+            MockRule("a", ["ralph"]),
+            MockRule("b", None),
+            MockRule("c", ["toshio", "ralph"]),
+            MockRule("d", [], error=ValueError("boom")),
+            MockRule("e", []),
+            MockRule("f", ["lmacken"]),
+        ]
+
+    def test_in_order(self):
+        """ Test that results come back in rule order, not finishing order """
+        with patch('datanommer.models.session.remove') as remove:
+            results = list(self.consumer._evaluate(self.rules, {}, None))
+        eq_([rule.name for rule, recipients, error in results],
+            ["a", "c", "d", "e", "f"])
+        eq_(remove.call_count, 5)
+        eq_([recipients for rule, recipients, error in results],
+            [set(["ralph"]), set(["toshio", "ralph"]), None, set(),
+             set(["lmacken"])])
+        eq_(results[2][2][0], ValueError)
+        eq_([rule.triggers for rule in self.rules], [1] * len(self.rules))
+
+    def test_concurrency_limit(self):
+        """ Test that no more than `concurrency` rules run at once """
+        lock = threading.Lock()
+        running = [0, 0]
+
+        class CountingRule(MockRule):
+            def matches(rule, msg, subs=None, triggered=False):
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                time.sleep(0.01)
+                with lock:
+                    running[0] -= 1
+                return set()
+
+        rules = [CountingRule(str(i), []) for i in range(10)]
+        eq_(len(list(self.consumer._evaluate(rules, {}, None))), 10)
+        eq_(running[1], 3)
+
+    def test_awards_in_order(self):
+        msg = dict(body=dict(topic="org.fedoraproject.prod.a.b",
+                             msg_id="1234", msg={}))
+        self.consumer.rule_index = fedbadges.dispatch.RuleIndex([])
+        self.consumer.rule_index.candidates = lambda msg, subs: self.rules
+        self.consumer.incoming = MockQueue()
+        self.consumer.consume_delay = 0
+        with patch.object(self.consumer, 'award_badge') as award:
+            self.consumer.consume(msg)
+        eq_([(args[0], args[1].name) for args, kwargs in award.call_args_list],
+            [("ralph", "a"), ("ralph", "c"), ("toshio", "c"),
+             ("lmacken", "f")])
+
+
+class MockQueue(object):
+    def qsize(self):
+        return 0
+
+
+class TestStop(unittest.TestCase):
+
+    @patch('fedmsg.init')
+    @patch('badgrclient.BadgrClient._get_auth_token')
+    @patch('badgrclient.BadgrClient._call_api')
+    @patch('badgrclient.Issuer.create')
+    @patch('badgrclient.BadgeClass.create')
+    def test_executor_is_shut_down(self, create_badge, create_issuer,
+                                   _call_api, _get_auth_token, fedmsg_init):
+        hub = MockHub()
+        hub.config = dict(hub.config, **{"badges.concurrency": 3})
+        consumer = fedbadges.consumers.FedoraBadgesConsumer(hub)
+        with patch('moksha.hub.api.consumer.Consumer.stop'):
+            consumer.stop()
+        with self.assertRaises(RuntimeError):
+            consumer.executor.submit(lambda: None)
@@ -0,0 +1,152 @@
+import unittest
+import mock
+from nose.tools import eq_
+
+import fedbadges.rules
+import fedbadges.counters
+from fedbadges.counters import CounterStore, topic_category
+
+
+class TestCounterStore(unittest.TestCase):
+    def setUp(self):
+        self.store = CounterStore()
+        self.store.load([
+            ("ralph", "git", "org.fedoraproject.prod.git.receive", 40),
+            ("ralph", "git", "org.fedoraproject.prod.git.lookaside.new", 2),
+            ("ralph", "bodhi", "org.fedoraproject.prod.bodhi.update.comment", 7),
+            ("toshio", "git", "org.fedoraproject.prod.git.receive", 3),
+        ], ["git", "bodhi"], 1000.0)
+
+    def test_topic_category(self):
+        eq_(topic_category("org.fedoraproject.prod.git.receive"), "git")
+        eq_(topic_category("/topic/VirtualTopic.eng.git.push"), "git")
+        eq_(topic_category("short"), None)
+        eq_(topic_category(None), None)
+
+    def test_disabled(self):
+        store = CounterStore()
+        eq_(store.count(dict(users=["ralph"], categories=["git"])), None)
+
+    def test_count(self):
+        eq_(self.store.count(dict(
+            users=["ralph"],
+            topics=["org.fedoraproject.prod.git.receive"])), 40)
+        eq_(self.store.count(dict(users=["ralph"], categories=["git"])), 42)
+        eq_(self.store.count(dict(
+            users=["ralph"], categories=["git", "bodhi", "git"])), 49)
+        eq_(self.store.count(dict(users=["nobody"], categories=["git"])), 0)
+
+    def test_unrepresentable(self):
+        for kwargs in [
+                dict(users=["ralph", "toshio"], categories=["git"]),
+                dict(users=["ralph"]),
+                dict(categories=["git"]),
+                dict(users=["ralph"], categories=["wiki"]),
+                dict(users=["ralph"], categories=["git"], topics=["x"]),
+                dict(users=["ralph"], not_categories=["git"]),
+                dict(users=["ralph"], categories=[]),
+                dict(users=["ralph"],
+                     topics=["org.fedoraproject.prod.wiki.article.edit"])]:
+            eq_(self.store.count(kwargs), None)
+
+    def test_message_arrived(self):
+        msg = dict(topic="org.fedoraproject.prod.git.receive",
+                   timestamp=1001.0)
+        self.store.message_arrived(msg, ["ralph", "ralph", "toshio"])
+        eq_(self.store.count(dict(users=["ralph"], categories=["git"])), 43)
+        eq_(self.store.count(dict(users=["toshio"], categories=["git"])), 4)
+
+    def test_seeded_messages_are_not_counted_twice(self):
+        msg = dict(topic="org.fedoraproject.prod.git.receive",
+                   timestamp=999.0)
+        self.store.message_arrived(msg, ["ralph"])
+        eq_(self.store.count(dict(users=["ralph"], categories=["git"])), 42)
+
+    def test_messages_datanommer_had_not_stored(self):
+        self.store.load([
+            ("ralph", "git", "org.fedoraproject.prod.git.receive", 40),
+        ], ["git"], 1000.0, ["stored"])
+        topic = "org.fedoraproject.prod.git.receive"
+        for msg_id, timestamp in [("stored", 990.0),
+                                  ("lagging", 995.0),
+                                  ("ancient", 100.0),
+                                  ("new", 1001.0),
+                                  ("new", 1001.0)]:
+            msg = dict(topic=topic, timestamp=timestamp, msg_id=msg_id)
+            self.store.message_arrived(msg, ["ralph"])
+        eq_(self.store.count(dict(users=["ralph"], categories=["git"])), 42)
+
+    def test_untracked_categories_are_ignored(self):
+        msg = dict(topic="org.fedoraproject.prod.wiki.article.edit",
+                   timestamp=1001.0)
+        self.store.message_arrived(msg, ["ralph"])
+        eq_(len(self.store), 7)
+
+
+class TestCountCategories(unittest.TestCase):
+    def make_rule(self, trigger, filter):
+        return fedbadges.rules.BadgeRule(dict(
+            name="Counted",
+            description="Doesn't matter...",
+            creator="Somebody",
+            discussion="http://somelink.com",
+            issuer_id="fedora-project",
+            image_url="http://somelinke.com/something.png",
+            trigger=trigger,
+            criteria=dict(datanommer=dict(
+                filter=filter,
+                operation="count",
+                condition={"greater than or equal to": 1}
+            ))
+        ), None, None)
+
+    def test_literal_filter(self):
+        rule = self.make_rule(dict(category="wiki"), dict(
+            topics=["org.fedoraproject.prod.git.receive"],
+            categories=["bodhi"]))
+        eq_(fedbadges.counters.count_categories(rule), set(["git", "bodhi"]))
+
+    def test_filter_from_message(self):
+        rule = self.make_rule({"any": [
+            dict(category="wiki"),
+            dict(topic="org.fedoraproject.prod.git.receive"),
+            dict(topic="comment"),
+        ]}, dict(topics=["%(topic)s"], users=["%(msg.user)s"]))
+        eq_(fedbadges.counters.count_categories(rule), set(["git", "wiki"]))
+
+
+class TestCounterCriteria(unittest.TestCase):
+    def setUp(self):
+        fedbadges.rules.counter_store.load([
+            ("ralph", "git", "org.fedoraproject.prod.git.receive", 40),
+        ], ["git"], 1000.0)
+        self.criteria = fedbadges.rules.Criteria(dict(
+            datanommer={
+                "filter": {
+                    "topics": ["%(topic)s"],
+                    "users": ["%(msg.agent)s"],
+                },
+                "operation": "count",
+                "condition": {
+                    "greater than or equal to": 40,
+                }
+            }
+        ))
+
+    def tearDown(self):
+        fedbadges.rules.counter_store.clear()
+
+    def test_counted_locally(self):
+        message = dict(topic="org.fedoraproject.prod.git.receive",
+                       msg=dict(agent="ralph"))
+        with mock.patch('datanommer.models.Message.grep') as f:
+            eq_(self.criteria.matches(message), True)
+            eq_(f.call_count, 0)
+
+    def test_falls_back_to_datanommer(self):
+        message = dict(topic="org.fedoraproject.prod.wiki.article.edit",
+                       msg=dict(agent="ralph"))
+        with mock.patch('datanommer.models.Message.grep') as f:
+            f.return_value = 50, None, None
+            eq_(self.criteria.matches(message), True)
+            eq_(f.call_count, 1)
@@ -1,7 +1,14 @@
+import contextlib
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 import mock
+import sqlalchemy
 from nose.tools import raises, eq_
 
+import datanommer.models
 import fedbadges.rules
 
 
@@ -395,3 +402,194 @@ class TestCriteriaDottedFilter(unittest.TestCase):
             f.return_value = None, None, self.mock_query
             result = self.criteria.matches(self.message)
             f.assert_called_once_with(users=['ralph'], defer=True)
+
+
+class TestBoundedCount(unittest.TestCase):
+    def make_criteria(self, condition, filter=None):
+        return fedbadges.rules.Criteria(dict(
+            datanommer={
+                "filter": filter or {"topics": ["%(topic)s"]},
+                "operation": "count",
+                "condition": condition,
+            }
+        )).specialization
+
+    def setUp(self):
+        self.message = dict(topic="org.fedoraproject.dev.bounded.topic")
+        fedbadges.rules.bounded_counts = True
+
+    def tearDown(self):
+        fedbadges.rules.bounded_counts = False
+
+    def test_limits(self):
+        """ Test how far each condition needs to count """
+        for condition, limit in [
+                ({"greater than or equal to": 3}, 3),
+                ({"less than": 3}, 3),
+                ({"greater than": 3}, 4),
+                ({"less than or equal to": 3}, 4),
+                ({"equal to": 3}, 4),
+                ({"is not": 3}, 4),
+                ({"lambda": "value > 3"}, None),
+                ({"greater than or equal to": 2.5}, None)]:
+            criteria = self.make_criteria(condition)
+            eq_(criteria.count_limit, limit)
+            eq_(criteria.shared_count_limit, limit)
+
+    def make_rule(self, specialization):
+        return mock.Mock(criteria=mock.Mock(
+            children=None, specialization=specialization))
+
+    def test_series_shares_a_limit(self):
+        filter = {"users": ["%(msg.agent)s"], "topics": ["series"]}
+        series = [
+            self.make_criteria({"greater than or equal to": threshold},
+                               filter)
+            for threshold in (50, 1, 10)
+        ]
+        other = self.make_criteria({"greater than or equal to": 3})
+        rules = [self.make_rule(criteria) for criteria in series + [other]]
+        fedbadges.rules.share_count_limits(rules)
+        eq_([criteria.shared_count_limit for criteria in series],
+            [50, 50, 50])
+        eq_(other.shared_count_limit, 3)
+
+        # One exact count spoils it for the whole series.
+        exact = self.make_criteria({"lambda": "value % 2"}, filter)
+        rules.append(self.make_rule(exact))
+        fedbadges.rules.share_count_limits(rules)
+        eq_([criteria.shared_count_limit for criteria in series],
+            [None, None, None])
+        eq_(other.shared_count_limit, 3)
+
+    def test_bounded_count_is_used(self):
+        criteria = self.make_criteria({"greater than or equal to": 5})
+        with mock.patch('fedbadges.rules.bounded_count') as count:
+            with mock.patch('datanommer.models.Message.grep') as grep:
+                count.return_value = 5
+                eq_(criteria.matches(self.message), True)
+                count.assert_called_once_with(
+                    dict(topics=[self.message['topic']]), 5)
+                eq_(grep.call_count, 0)
+
+    def test_exact_count_when_off(self):
+        fedbadges.rules.bounded_counts = False
+        criteria = self.make_criteria({"greater than or equal to": 5})
+        with mock.patch('fedbadges.rules.bounded_count') as count:
+            with mock.patch('datanommer.models.Message.grep') as grep:
+                grep.return_value = 50000, None, None
+                eq_(criteria.matches(self.message), True)
+                eq_(count.call_count, 0)
+
+
+class TestCriteriaOrdering(unittest.TestCase):
+    def setUp(self):
+        child = {
+            "datanommer": {
+                "filter": {"topics": ["%(topic)s"]},
+                "operation": "count",
+                "condition": {"greater than or equal to": 1},
+            }
+        }
+        self.criteria = fedbadges.rules.Criteria({"all": [child, child]})
+        self.calls = []
+
+        def expensive(msg, subs=None):
+            self.calls.append("expensive")
+            self.clock[0] += 10
+            return True
+
+        def cheap(msg, subs=None):
+            self.calls.append("cheap")
+            self.clock[0] += 1
+            return False
+
+        self.criteria.children[0].matches = expensive
+        self.criteria.children[1].matches = cheap
+        self.clock = [0.0]
+
+    def tearDown(self):
+        fedbadges.rules.pin_criteria_order = False
+
+    def run_criteria(self, times):
+        with mock.patch('time.monotonic', lambda: self.clock[0]):
+            results = [self.criteria.matches({}) for i in range(times)]
+        eq_(results, [False] * times)
+
+    def test_cheap_and_decisive_first(self):
+        self.run_criteria(3)
+        eq_(self.calls, ["expensive", "cheap", "cheap", "cheap"])
+
+    def test_pinned(self):
+        fedbadges.rules.pin_criteria_order = True
+        self.run_criteria(2)
+        eq_(self.calls, ["expensive", "cheap", "expensive", "cheap"])
+
+    def test_statistics_from_many_threads(self):
+        def run():
+            for i in range(500):
+                self.criteria.matches({})
+
+        threads = [threading.Thread(target=run) for i in range(8)]
+        with mock.patch('time.monotonic', lambda: self.clock[0]):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # The cheap child decides every time, once it's known to be cheap.
+        calls = [stats[0] for stats in self.criteria.child_stats]
+        eq_(calls[1], 4000)
+        eq_(self.criteria.child_stats[1][2], 4000)
+        eq_(self.calls.count("expensive"), calls[0])
+
+
+class TestDatanommerConnections(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = sqlalchemy.create_engine(
+            "sqlite:///" + os.path.join(self.directory, "datanommer.db"),
+            poolclass=sqlalchemy.pool.QueuePool,
+            pool_size=2, max_overflow=0, pool_timeout=1)
+        self.bind = datanommer.models.maker.kw.get('bind')
+        datanommer.models.maker.configure(bind=self.engine)
+        fedbadges.rules.datanommer_budget = threading.BoundedSemaphore(1)
+        self.criteria = fedbadges.rules.Criteria(dict(
+            datanommer={
+                "filter": {"users": ["%(msg.agent)s"]},
+                "operation": "count",
+                "condition": {"greater than or equal to": 1},
+            }
+        ))
+
+    def tearDown(self):
+        datanommer.models.session.remove()
+        datanommer.models.maker.configure(bind=self.bind)
+        fedbadges.rules.datanommer_budget = contextlib.nullcontext()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_connections_are_given_back(self):
+        """ Test that more threads than connections can take turns """
+        def query(msg, subs, kwargs, expression):
+            return datanommer.models.session.execute(
+                sqlalchemy.text("SELECT 1")).scalar()
+
+        results = []
+
+        def run(user):
+            try:
+                results.append(self.criteria.matches(
+                    dict(topic="a.b.c.d", msg=dict(agent=user))))
+            except Exception as e:
+                results.append(type(e).__name__)
+
+        threads = [threading.Thread(target=run, args=("user%i" % i,))
+                   for i in range(4)]
+        with mock.patch.object(fedbadges.rules.DatanommerCriteria,
+                               '_run_operation', side_effect=query):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        eq_(results, [True] * 4)
+        eq_(self.engine.pool.checkedout(), 0)
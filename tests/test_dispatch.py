@@ -0,0 +1,112 @@
+import unittest
+
+import fedbadges.rules
+import fedbadges.dispatch
+
+from nose.tools import eq_
+
+
+def make_rule(name, trigger):
+    return fedbadges.rules.BadgeRule(dict(
+        name=name,
+        description="Doesn't matter...",
+        creator="Somebody",
+        discussion="http://somelink.com",
+        issuer_id="fedora-project",
+        image_url="http://somelinke.com/something.png",
+        trigger=trigger,
+        criteria=dict(datanommer=dict(
+            filter=dict(topics=["%(topic)s"]),
+            operation="count",
+            condition={"greater than or equal to": 1}
+        ))
+    ), None, None)
+
+
+class TestRuleIndex(unittest.TestCase):
+    def setUp(self):
+        self.rules = [
+            make_rule("topic", dict(topic="bodhi.update.comment")),
+            make_rule("category", dict(category="git")),
+            make_rule("any", {"any": [
+                dict(topic="fedoratagger.tag.create"),
+                dict(category="wiki"),
+            ]}),
+            make_rule("all", {"all": [
+                dict(category="fedoratagger"),
+                {"lambda": "msg.get('msg') is not None"},
+            ]}),
+            make_rule("lambda", {"lambda": "'foo' in json.dumps(msg)"}),
+            make_rule("not", {"not": dict(category="bodhi")}),
+            make_rule("partial", dict(topic="comment")),
+            make_rule("field", {"field": dict(
+                path="msg.agent", **{"in": ["ralph", "toshio"]})}),
+            make_rule("regex", {"field": dict(
+                path="msg.agent", regex="^r")}),
+            make_rule("contains", {"contains": ["ralph", "s3kr3t"]}),
+        ]
+        self.index = fedbadges.dispatch.RuleIndex(self.rules)
+        self.messages = [
+            dict(topic="org.fedoraproject.prod.bodhi.update.comment", msg={}),
+            dict(topic="org.fedoraproject.prod.bodhi.update.xcomment"),
+            dict(topic="org.fedoraproject.prod.git.receive", msg={}),
+            dict(topic="org.fedoraproject.prod.wiki.article.edit"),
+            dict(topic="org.fedoraproject.prod.fedoratagger.tag.create"),
+            dict(topic="org.fedoraproject.prod.fedoratagger.tag.update",
+                 msg={}),
+            dict(topic="short"),
+            dict(topic="comment"),
+            dict(topic="org.fedoraproject.prod.fas.user.update",
+                 msg=dict(agent="ralph")),
+            dict(topic="org.fedoraproject.prod.fas.user.update",
+                 msg=dict(agent=["ralph"])),
+        ]
+
+    def test_unindexable(self):
+        """ Test that lambdas and negations are always candidates. """
+        names = [self.rules[i]['name'] for i in self.index.unindexed]
+        eq_(names, ["lambda", "not", "regex"])
+
+    def test_same_as_linear_scan(self):
+        """ Test that the index never drops a rule that would match. """
+        for msg in self.messages:
+            expected = [r for r in self.rules if r.trigger.matches(msg)]
+            actual = [r for r in self.index.candidates(msg)
+                      if r.trigger.matches(msg)]
+            eq_(actual, expected)
+
+    def test_candidates_are_narrowed(self):
+        """ Test that rules for unrelated topics are not candidates. """
+        msg = dict(topic="org.fedoraproject.prod.git.receive")
+        names = [r['name'] for r in self.index.candidates(msg)]
+        eq_(names, ["category", "lambda", "not", "regex"])
+
+    def test_suffix_matching(self):
+        """ Test that topic suffixes which are not dotted still match. """
+        msg = dict(topic="org.fedoraproject.prod.bodhi.update.xcomment")
+        names = [r['name'] for r in self.index.candidates(msg)]
+        eq_(names, ["lambda", "not", "partial", "regex"])
+
+    def test_field(self):
+        """ Test that exact field comparisons are looked up. """
+        msg = dict(topic="org.fedoraproject.prod.fas.user.update",
+                   msg=dict(agent="toshio"))
+        names = [r['name'] for r in self.index.candidates(msg)]
+        eq_(names, ["lambda", "not", "field", "regex"])
+
+    def test_contains(self):
+        """ Test that contains triggers are found by the pattern matcher. """
+        msg = dict(topic="org.fedoraproject.prod.wiki.article.edit",
+                   msg=dict(secret="s3kr3t"))
+        names = [r['name'] for r in self.index.candidates(msg)]
+        eq_(names, ["any", "lambda", "not", "regex", "contains"])
+
+    def test_pattern_matcher(self):
+        matcher = fedbadges.dispatch.PatternMatcher(["foo", "bar", "foo"])
+        eq_(len(matcher), 2)
+        eq_(matcher.search("xxfooxxbarfoo"), set(["foo", "bar"]))
+        eq_(matcher.search("baz"), set())
+
+    def test_odd_topic(self):
+        """ Test that messages without a string topic see every rule. """
+        eq_(self.index.candidates(dict(topic=None)), self.rules)
@@ -0,0 +1,61 @@
+import unittest
+import urllib.request
+
+from nose.tools import eq_
+
+import fedbadges.metrics
+from fedbadges.metrics import Counter, Histogram
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        counter = Counter('things_total', 'Some things.', ('rule', 'stage'))
+        counter.inc(('Like a Rock', 'trigger'))
+        counter.inc(('Like a Rock', 'trigger'))
+        counter.inc(('Say "hi"', 'award'), 3)
+        eq_(counter.render(), [
+            '# HELP things_total Some things.',
+            '# TYPE things_total counter',
+            'things_total{rule="Like a Rock",stage="trigger"} 2',
+            'things_total{rule="Say \\"hi\\"",stage="award"} 3',
+        ])
+
+    def test_histogram(self):
+        histogram = Histogram('took_seconds', 'Time.', ('rule',),
+                              buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(('a',), value)
+        eq_(histogram.count(('a',)), 4)
+        eq_(histogram.render(), [
+            '# HELP took_seconds Time.',
+            '# TYPE took_seconds histogram',
+            'took_seconds_bucket{rule="a",le="0.1"} 2',
+            'took_seconds_bucket{rule="a",le="1.0"} 3',
+            'took_seconds_bucket{rule="a",le="+Inf"} 4',
+            'took_seconds_sum{rule="a"} 5.65',
+            'took_seconds_count{rule="a"} 4',
+        ])
+
+    def test_disabled(self):
+        fedbadges.metrics.observe('rule', 'test-disabled', 0, 'hit')
+        eq_(fedbadges.metrics.stage_total.get(
+            ('rule', 'test-disabled', 'hit')), 0)
+
+    def test_serve(self):
+        fedbadges.metrics.enabled = True
+        try:
+            fedbadges.metrics.observe(
+                'rule', 'test-serve', fedbadges.metrics.clock(), 'hit')
+        finally:
+            fedbadges.metrics.enabled = False
+        server = fedbadges.metrics.serve(0, '127.0.0.1')
+        try:
+            url = 'http://127.0.0.1:%i/metrics' % server.server_address[1]
+            body = urllib.request.urlopen(url).read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert 'fedbadges_stage_total{rule="rule",stage="test-serve",' \
+            'outcome="hit"} 1' in body, body
+        assert 'fedbadges_stage_seconds_count{rule="rule",' \
+            'stage="test-serve"} 1' in body, body
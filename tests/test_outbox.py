@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import eq_
+
+from fedbadges.awards import AwardWriter
+from fedbadges.outbox import AwardOutbox
+
+# Utils for tests
+from .utils import MockRule
+
+
+class TestAwardOutbox(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'outbox.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_survives_restart(self):
+        outbox = AwardOutbox(self.path)
+        first = outbox.record('badge1', 'ralph', 'http://link')
+        outbox.record('badge1', 'toshio')
+        outbox.done(first)
+        outbox.close()
+
+        outbox = AwardOutbox(self.path)
+        eq_([row[1:] for row in outbox.pending()],
+            [('badge1', 'toshio', None)])
+        eq_(outbox.stats(), dict(size=2, pending=1))
+        eq_(outbox.compact(), 1)
+        eq_(outbox.stats(), dict(size=1, pending=1))
+        outbox.close()
+
+
+class TestAwardWriterOutbox(unittest.TestCase):
+    def setUp(self):
+        self.outbox = AwardOutbox(':memory:')
+        self.awarded = []
+        self.down = False
+
+    def award(self, username, badge_rule, link):
+        if self.down:
+            raise IOError("badgr is down")
+        self.awarded.append((badge_rule.badge_id, username))
+
+    def test_done_once_awarded(self):
+        writer = AwardWriter(self.award, outbox=self.outbox)
+        writer.submit('ralph', MockRule('badge1'))
+        eq_(self.outbox.stats(), dict(size=1, pending=0))
+
+    def test_kept_when_badgr_is_down(self):
+        self.down = True
+        writer = AwardWriter(self.award, workers=1, retries=1,
+                             sleep=lambda delay: None, outbox=self.outbox)
+        writer.start()
+        writer.submit('ralph', MockRule('badge1'), 'http://link')
+        writer.stop()
+        eq_([row[1:] for row in self.outbox.pending()],
+            [('badge1', 'ralph', 'http://link')])
+
+        # Badgr is back, and so are we.
+        self.down = False
+        writer = AwardWriter(self.award, outbox=self.outbox)
+        eq_(writer.replay([MockRule('badge1'), MockRule('badge2')]), 1)
+        eq_(self.awarded, [('badge1', 'ralph')])
+        eq_(self.outbox.pending(), [])
+
+    def test_replay_skips_unknown_badges(self):
+        self.outbox.record('gone', 'ralph')
+        writer = AwardWriter(self.award, outbox=self.outbox)
+        eq_(writer.replay([MockRule('badge1')]), 0)
+        eq_(len(self.outbox.pending()), 1)
+
+    def test_replayed_duplicates_are_done(self):
+        self.outbox.record('badge1', 'ralph')
+        self.outbox.record('badge1', 'ralph')
+        writer = AwardWriter(self.award, workers=1, outbox=self.outbox)
+        writer.start()
+        writer.replay([MockRule('badge1')])
+        writer.stop()
+        eq_(self.outbox.pending(), [])
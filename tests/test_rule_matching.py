@@ -53,8 +53,8 @@ class TestRuleMatching(unittest.TestCase):
 
         with patch("datanommer.models.Message.grep") as f:
             f.return_value = 1, 1, query
-            with patch("fedbadges.rules.user_exists_in_fas") as g:
-                g.return_value = True
+            with patch("fedbadges.rules.users_exist_in_fas") as g:
+                g.side_effect = lambda config, users: set(users)
                 eq_(rule.matches(msg), set(['lmacken', 'hadess']))
 
     def test_full_simple_match_almost_succeed(self):
@@ -135,8 +135,8 @@ class TestRuleMatching(unittest.TestCase):
 
         with patch("datanommer.models.Message.grep") as f:
             f.return_value = 1, 1, query
-            with patch("fedbadges.rules.user_exists_in_fas") as g:
-                g.return_value = True
+            with patch("fedbadges.rules.users_exist_in_fas") as g:
+                g.side_effect = lambda config, users: set(users)
                 eq_(rule.matches(msg), set(['toshio']))
 
     def test_yaml_specified_awardee_failure(self):
@@ -174,8 +174,8 @@ class TestRuleMatching(unittest.TestCase):
 
         with patch("datanommer.models.Message.grep") as f:
             f.return_value = 1, 1, query
-            with patch("fedbadges.rules.user_exists_in_fas") as g:
-                g.return_value = True
+            with patch("fedbadges.rules.users_exist_in_fas") as g:
+                g.side_effect = lambda config, users: set(users)
                 eq_(rule.matches(msg), set(['toshio', 'ralph']))
 
     @patch('badgrclient.BadgeClass.create')
@@ -230,8 +230,8 @@ class TestRuleMatching(unittest.TestCase):
 
         with patch("datanommer.models.Message.grep") as f:
             f.return_value = 1, 1, datanommer_query
-            with patch("fedbadges.rules.user_exists_in_fas") as g:
-                g.return_value = True
+            with patch("fedbadges.rules.users_exist_in_fas") as g:
+                g.side_effect = lambda config, users: set(users)
                 eq_(rule.matches(msg), set(['ralph']))
 
     @patch.dict(
@@ -241,7 +241,8 @@ class TestRuleMatching(unittest.TestCase):
             "fasjson_base_url": "https://fasjson.example.com/v1/",
         }
     )
-    @patch("fedbadges.rules.user_exists_in_fas", Mock(return_value=True))
+    @patch("fedbadges.rules.users_exist_in_fas",
+           Mock(side_effect=lambda config, users: set(users)))
     def test_github_awardee(self):
         """Conversion from GitHub URI to FAS users"""
         rule = fedbadges.rules.BadgeRule(dict(
@@ -334,8 +335,8 @@ class TestRuleMatching(unittest.TestCase):
 
         with patch("datanommer.models.Message.grep") as f:
             f.return_value = 1, 1, query
-            with patch("fedbadges.rules.user_exists_in_fas") as g:
-                g.return_value = True
+            with patch("fedbadges.rules.users_exist_in_fas") as g:
+                g.side_effect = lambda config, users: set(users)
                 eq_(rule.matches(msg), set(['packagerbot']))
 
 
@@ -1,9 +1,11 @@
 import unittest
 
-from nose.tools import raises
+from nose.tools import eq_, raises
 
 import fedbadges.rules
 
+from fedbadges.utils import Substitutions
+
 
 class TestTriggerMatching(unittest.TestCase):
     def test_basic_topic_matching_isolated(self):
@@ -72,6 +74,65 @@ class TestTriggerMatching(unittest.TestCase):
         )
         assert(not trigger.matches(message))
 
+    def test_field_equals(self):
+        """ Test that field triggers compare the value at a path """
+        trigger = fedbadges.rules.Trigger({
+            "field": dict(path="msg.agent", equals="ralph"),
+        })
+        assert(trigger.matches(dict(msg=dict(agent="ralph"))))
+        assert(not trigger.matches(dict(msg=dict(agent="Ralph"))))
+        assert(not trigger.matches(dict(msg=dict())))
+        assert(not trigger.matches(dict(msg=None)))
+
+    def test_field_comparisons(self):
+        """ Test the other kinds of field comparisons """
+        message = dict(msg=dict(
+            agent="ralph",
+            commits=[dict(message="Fix the foo bar")],
+        ))
+        cases = [
+            (dict(path="msg.agent", **{"in": ["ralph", "toshio"]}), True),
+            (dict(path="msg.agent", **{"in": ["toshio"]}), False),
+            (dict(path="msg.commits.0.message", contains="foo"), True),
+            (dict(path="msg.commits.1.message", contains="foo"), False),
+            (dict(path="msg.commits", contains="foo"), False),
+            (dict(path="msg.commits.0.message", regex="^Fix"), True),
+            (dict(path="msg.agent", regex="^Fix"), False),
+        ]
+        for spec, expected in cases:
+            trigger = fedbadges.rules.Trigger(dict(field=spec))
+            eq_(bool(trigger.matches(message)), expected)
+            compiled = trigger.compile()
+            eq_(bool(compiled(message, Substitutions(message))), expected)
+
+    def test_contains(self):
+        """ Test that contains triggers search the serialized message """
+        trigger = fedbadges.rules.Trigger({
+            "contains": ["one string", "s3kr3t"],
+        })
+        message = dict(msg=dict(nested=dict(something="s3kr3t")))
+        assert(trigger.matches(message))
+        assert(trigger.compile()(message, Substitutions(message)))
+        message = dict(msg=dict(nested=dict(something="another string")))
+        assert(not trigger.matches(message))
+        assert(not trigger.compile()(message, Substitutions(message)))
+
+    @raises(TypeError)
+    def test_contains_only_strings(self):
+        trigger = fedbadges.rules.Trigger({"contains": [1, 2]})
+
+    @raises(ValueError)
+    def test_field_needs_one_comparison(self):
+        trigger = fedbadges.rules.Trigger({
+            "field": dict(path="msg.agent", equals="ralph", regex="ralph"),
+        })
+
+    @raises(ValueError)
+    def test_field_invalid_regex(self):
+        trigger = fedbadges.rules.Trigger({
+            "field": dict(path="msg.agent", regex="(unclosed"),
+        })
+
     @raises(TypeError)
     def test_invalid_nesting(self):
         """ Test that invalid nesting is detected and excepted. """
@@ -96,3 +157,83 @@ class TestTriggerMatching(unittest.TestCase):
         trigger = fedbadges.rules.Trigger(dict(
             watwat="does not exist",
         ))
+
+    @raises(ValueError)
+    def test_invalid_lambda(self):
+        """ Test that lambdas which don't compile are rejected at load. """
+        trigger = fedbadges.rules.Trigger({
+            "lambda": "'unterminated in json.dumps(msg)",
+        })
+
+
+class TestTriggerCompiler(unittest.TestCase):
+    leaves = [
+        dict(topic="bodhi.update.comment"),
+        dict(topic="comment"),
+        dict(topic="org.fedoraproject.prod.git.receive"),
+        dict(category="bodhi"),
+        dict(category="git"),
+        dict(category=dict(any=["bodhi", "git"])),
+        {"lambda": "'s3kr3t' in json.dumps(msg)"},
+        {"lambda": "msg['msg']['user']['anonymous'] is False"},
+        {"field": dict(path="msg.secret", equals="s3kr3t")},
+        {"field": dict(path="msg.user.anonymous", contains="x")},
+        {"contains": "s3kr3t"},
+        {"contains": ["nope", "receive"]},
+    ]
+
+    messages = [
+        dict(topic="org.fedoraproject.prod.bodhi.update.comment"),
+        dict(topic="org.fedoraproject.prod.bodhi.update.xcomment",
+             msg=dict(user=dict(anonymous=False))),
+        dict(topic="org.fedoraproject.prod.git.receive",
+             msg=dict(secret="s3kr3t")),
+        dict(topic="org.fedoraproject.prod.git.receive",
+             msg=dict(user=None)),
+        dict(topic="too.short"),
+        dict(topic=None),
+        dict(),
+    ]
+
+    def random_tree(self, rng, depth=0):
+        if depth > 2 or rng.random() < 0.3:
+            return rng.choice(self.leaves)
+        operator = rng.choice(["any", "all", "not"])
+        if operator == "not":
+            return {"not": self.random_tree(rng, depth + 1)}
+        return {operator: [
+            self.random_tree(rng, depth + 1)
+            for i in range(rng.randint(1, 3))
+        ]}
+
+    def test_compiled_matches_tree(self):
+        """ Test that compiled triggers agree with the tree walker. """
+        import random
+        rng = random.Random(42)
+        for i in range(300):
+            trigger = fedbadges.rules.Trigger(self.random_tree(rng))
+            compiled = trigger.compile()
+            for message in self.messages:
+                expected = bool(trigger.matches(message))
+                try:
+                    actual = bool(compiled(message, Substitutions(message)))
+                except Exception:
+                    # Errors are handled by the rule's error boundary.
+                    actual = False
+                assert actual == expected, (trigger, message)
+
+    def test_any_of_topics(self):
+        """ Test the fast path for a list of topic alternatives. """
+        trigger = fedbadges.rules.Trigger({
+            "any": [
+                dict(topic="fedoratagger.tag.create"),
+                dict(topic="fedoratagger.tag.update"),
+            ]
+        })
+        compiled = trigger.compile()
+        for topic, expected in [
+            ("org.fedoraproject.prod.fedoratagger.tag.update", True),
+            ("org.fedoraproject.prod.fedoratagger.tag.remove", False),
+        ]:
+            message = dict(topic=topic)
+            eq_(compiled(message, Substitutions(message)), expected)
@@ -1,10 +1,21 @@
+import copy
 import unittest
+import mock
 from nose.tools import eq_, raises
 
+import fedbadges.utils
 from fedbadges.utils import (
+    Substitutions,
+    Template,
+    recursive_lambda_factory,
     construct_substitutions,
     format_args,
+    compile_lambda,
+    cached_lambda,
+    lambda_cache_stats,
     single_argument_lambda_factory,
+    user_exists_in_fas,
+    users_exist_in_fas,
 )
 
 
@@ -15,6 +26,22 @@ class TestLambdaFactory(unittest.TestCase):
         actual = single_argument_lambda_factory(expression, 2)
         eq_(actual, target)
 
+    def test_compile(self):
+        function = compile_lambda("msg['topic']", name='msg')
+        eq_(function(dict(topic="foo")), "foo")
+
+    @raises(ValueError)
+    def test_compile_syntax_error(self):
+        compile_lambda("value +")
+
+    def test_cache(self):
+        cached_lambda.cache_clear()
+        single_argument_lambda_factory("value * 3", 2)
+        single_argument_lambda_factory("value * 3", 4)
+        stats = lambda_cache_stats()
+        eq_(stats['misses'], 1)
+        eq_(stats['hits'], 1)
+
 
 class TestSubsitutions(unittest.TestCase):
     def test_basic(self):
@@ -112,6 +139,52 @@ class TestSubsitutions(unittest.TestCase):
         eq_(actual, target)
 
 
+class TestLazySubstitutions(unittest.TestCase):
+    msg = {
+        "topic": "org.fedoraproject.prod.bodhi.update.comment",
+        "msg": {
+            "comment": {
+                "update_submitter": "LMacken",
+                "karma": 1,
+            },
+            "agent": "Ralph",
+            "tags": ["Foo"],
+        },
+    }
+
+    def test_same_as_eager(self):
+        """ Test that every eager key resolves to the same value. """
+        subs = Substitutions(self.msg)
+        eager = construct_substitutions(self.msg)
+        for key in eager:
+            eq_(subs[key], eager[key])
+        eq_(dict(subs), eager)
+
+    def test_lazy(self):
+        """ Test that simple lookups don't flatten the whole message. """
+        subs = Substitutions(self.msg)
+        eq_(subs['msg.comment.update_submitter'], 'lmacken')
+        eq_(subs['msg.tags'], ['Foo'])
+        assert 'msg.nonexistent' not in subs
+        assert 'msg.agent.name' not in subs
+        eq_(subs._flat, None)
+
+    def test_formatting(self):
+        """ Test that the view can be used with format_args. """
+        subs = Substitutions(self.msg)
+        actual = format_args(["%(msg.agent)s", "x%(msg.comment.karma)iy"], subs)
+        eq_(actual, ["ralph", "x1y"])
+
+    @raises(KeyError)
+    def test_missing(self):
+        Substitutions(self.msg)['msg.wat']
+
+    def test_dotted_keys(self):
+        """ Test that keys with dots in the message itself still resolve. """
+        msg = {"msg": {"a.b": {"c": "D"}}}
+        eq_(Substitutions(msg)['msg.a.b.c'], 'd')
+
+
 class TestFormatArgs(unittest.TestCase):
     def test_simple(self):
         subs = {
@@ -198,3 +271,110 @@ class TestFormatArgs(unittest.TestCase):
         actual = format_args(obj, subs)
         eq_(actual, target)
 
+
+class TestTemplate(unittest.TestCase):
+    msg = {
+        "topic": "org.fedoraproject.prod.pagure.git.receive",
+        "msg": {
+            "agent": "Ralph",
+            "authors": [{"name": "ralph"}, {"name": "lmacken"}],
+            "count": 3,
+        },
+    }
+
+    def render_old_way(self, obj):
+        subs = construct_substitutions(self.msg)
+        obj = format_args(copy.deepcopy(obj), subs)
+        return recursive_lambda_factory(obj, self.msg, name='msg')
+
+    def test_same_as_format_args(self):
+        obj = {
+            "topics": ["%(topic)s", "org.fedoraproject.prod.wiki.edit"],
+            "users": ["%(msg.authors)s"],
+            "nested": {"agent": "agent is %(msg.agent)s", "n": 4.5},
+            "count": "%(msg.count)i",
+            "packages": {"lambda": "[msg['msg']['agent']]"},
+            "contains": [{"lambda": "'%(msg.agent)s'.upper()"}],
+        }
+        template = Template(obj)
+        subs = Substitutions(self.msg)
+        eq_(template.render(subs, self.msg), self.render_old_way(obj))
+
+    def test_source_untouched(self):
+        """ Test that rendering doesn't modify the parsed source. """
+        obj = {"nested": {"users": ["%(msg.agent)s"], "agent": "%(msg.agent)s"}}
+        original = copy.deepcopy(obj)
+        template = Template(obj)
+        template.render(Substitutions(self.msg), self.msg)
+        eq_(obj, original)
+
+    def test_recipient(self):
+        """ Test that recipient templates leave lambdas alone. """
+        template = Template("%(msg.authors)s", lambdas=False)
+        eq_(template.render(Substitutions(self.msg)),
+            [{"name": "ralph"}, {"name": "lmacken"}])
+
+    @raises(ValueError)
+    def test_invalid_lambda(self):
+        Template({"users": {"lambda": "msg["}})
+
+
+class TestFASCache(unittest.TestCase):
+    config = {"fasjson_base_url": "https://fasjson.example.com/v1/"}
+
+    def setUp(self):
+        fedbadges.utils.fas_cache.configure(ttl=60, maxsize=10,
+                                            negative_ttl=10)
+        self.session = mock.Mock()
+        self.patcher = mock.patch('fedbadges.utils.get_fasjson_session',
+                                  return_value=self.session)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        fedbadges.utils.fas_cache.configure(ttl=0, maxsize=0)
+
+    def respond(self, status_code):
+        self.session.get.return_value = mock.Mock(
+            ok=status_code < 400, status_code=status_code)
+
+    def test_exists_is_cached(self):
+        self.respond(200)
+        eq_(user_exists_in_fas(self.config, "ralph"), True)
+        eq_(user_exists_in_fas(self.config, "ralph"), True)
+        eq_(self.session.get.call_count, 1)
+
+    def test_missing_is_cached(self):
+        self.respond(404)
+        eq_(user_exists_in_fas(self.config, "nobody"), False)
+        eq_(user_exists_in_fas(self.config, "nobody"), False)
+        eq_(self.session.get.call_count, 1)
+
+    def test_missing_not_cached_without_negative_ttl(self):
+        fedbadges.utils.fas_cache.configure(ttl=60, maxsize=10)
+        self.respond(404)
+        eq_(user_exists_in_fas(self.config, "nobody"), False)
+        eq_(user_exists_in_fas(self.config, "nobody"), False)
+        eq_(self.session.get.call_count, 2)
+
+    def test_errors_are_not_cached(self):
+        self.respond(503)
+        eq_(user_exists_in_fas(self.config, "ralph"), False)
+        self.respond(200)
+        eq_(user_exists_in_fas(self.config, "ralph"), True)
+        eq_(self.session.get.call_count, 2)
+
+
+class TestFASCheckForMany(TestFASCache):
+    def lookup(self, url, params=None, headers=None):
+        ok = not url.endswith("/nobody/")
+        return mock.Mock(ok=ok, status_code=200 if ok else 404)
+
+    def test_each_user_once(self):
+        self.session.get.side_effect = self.lookup
+        users = ["ralph", "toshio", "nobody", "ralph"]
+        eq_(users_exist_in_fas(self.config, users), {"ralph", "toshio"})
+        eq_(self.session.get.call_count, 3)
+        # And they're all in the cache now.
+        eq_(users_exist_in_fas(self.config, users), {"ralph", "toshio"})
+        eq_(self.session.get.call_count, 3)
@@ -1,7 +1,12 @@
+import datetime
+import os
+import shutil
+import tempfile
 import unittest
 
 import badgrclient
 import fedbadges.consumers
+import fedbadges.snapshot
 
 from mock import patch
 from nose.tools import eq_
@@ -35,3 +40,101 @@ class TestYamlCollector(unittest.TestCase):
             'Speak Up!',
             'Long Life to Pagure (Pagure I)',
             ]))
+
+
+class TestBadgeClassSync(unittest.TestCase):
+
+    @patch('fedmsg.init')
+    @patch('badgrclient.BadgrClient._get_auth_token')
+    @patch('badgrclient.BadgrClient._call_api')
+    @patch('badgrclient.BadgrClient.get_eid_from_badge_name')
+    @patch('badgrclient.Issuer.create')
+    @patch('badgrclient.BadgeClass.create', autospec=True)
+    def setUp(self, create_badge, create_issuer, get_eid, _call_api,
+              _get_auth_token, fedmsg_init):
+        def create(badge, name, **kwargs):
+            badge.entityId = "new-" + name
+            return badge
+
+        create_badge.side_effect = create
+        get_eid.side_effect = lambda name, issuer: \
+            "old" if name == "Speak Up!" else None
+        self.create_badge = create_badge
+        self.consumer = fedbadges.consumers.FedoraBadgesConsumer(MockHub())
+
+    def test_missing_are_created_once(self):
+        eq_(self.create_badge.call_count, 4)
+
+    def test_rules_get_badge_ids(self):
+        badge_ids = dict([(badge['name'], badge.badge_id)
+                          for badge in self.consumer.badge_rules])
+        eq_(badge_ids['Speak Up!'], 'old')
+        eq_(badge_ids['Like a Rock'], 'new-Like a Rock')
+
+
+class TestRulesetSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rules = os.path.join(self.directory, 'rules')
+        shutil.copytree('tests/test_badges', self.rules)
+        self.hub = MockHub()
+        self.hub.config = dict(self.hub.config, **{
+            "badges.yaml.directory": self.rules,
+            "badges.yaml.snapshot": os.path.join(self.directory, 'rules.json'),
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @patch('fedmsg.init')
+    @patch('badgrclient.BadgrClient._get_auth_token')
+    @patch('badgrclient.BadgrClient._call_api')
+    @patch('badgrclient.BadgrClient.get_eid_from_badge_name')
+    @patch('badgrclient.Issuer.create')
+    @patch('badgrclient.BadgeClass.create', autospec=True)
+    @patch('yaml.safe_load', wraps=fedbadges.consumers.yaml.safe_load)
+    def load(self, safe_load, create_badge, create_issuer, get_eid,
+             _call_api, _get_auth_token, fedmsg_init):
+        def create(badge, name, **kwargs):
+            badge.entityId = "new-" + name
+            return badge
+
+        create_badge.side_effect = create
+        get_eid.return_value = None
+        consumer = fedbadges.consumers.FedoraBadgesConsumer(self.hub)
+        badge_ids = dict([(badge['name'], badge.badge_id)
+                          for badge in consumer.badge_rules])
+        return badge_ids, safe_load.call_count, create_badge.call_count
+
+    def test_warm_start(self):
+        badge_ids, parsed, created = self.load()
+        eq_((parsed, created), (5, 5))
+        eq_(self.load(), (badge_ids, 0, 0))
+
+    def test_changed_rules_are_reloaded(self):
+        self.load()
+        with open(os.path.join(self.rules, 'tagger-01.yml'), 'a') as f:
+            f.write("\n# A comment\n")
+        badge_ids, parsed, created = self.load()
+        eq_((len(badge_ids), parsed), (5, 5))
+
+    def test_only_what_json_gives_back(self):
+        snapshot = fedbadges.snapshot.RulesetSnapshot(
+            os.path.join(self.directory, 'rules.json'))
+        for definition in [{"name": "a", "condition": {1: "one"}},
+                           {"name": "a", "when": datetime.date.today()}]:
+            eq_(snapshot.save('key', [('a.yml', definition)], {}), False)
+            eq_(snapshot.load('key'), None)
+        definitions = [('a.yml', {"name": "a", "condition": {"1": "one"}})]
+        eq_(snapshot.save('key', definitions, {"a": "eid"}), True)
+        eq_(snapshot.load('key'), (definitions, {"a": "eid"}))
+
+    def test_digest(self):
+        files = [('a.yml', b'name: a'), ('b.yml', b'name: b')]
+        eq_(fedbadges.snapshot.digest(files, 'issuer'),
+            fedbadges.snapshot.digest(files[::-1], 'issuer'))
+        assert fedbadges.snapshot.digest(files, 'issuer') != \
+            fedbadges.snapshot.digest(files, 'other')
+        assert fedbadges.snapshot.digest(files, 'issuer') != \
+            fedbadges.snapshot.digest([('a.yml', b'name: b'),
+                                       ('b.yml', b'name: a')], 'issuer')
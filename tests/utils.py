@@ -28,3 +28,20 @@ class MockHub(object):
 
     def subscribe(self, topic, callback):
         pass
+
+
+class FakeClock(object):
+    """ A clock which only moves when a test sets ``now``. """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class MockRule(object):
+    """ Just enough of a BadgeRule to be awarded. """
+
+    def __init__(self, badge_id):
+        self.badge_id = badge_id